@@ -530,7 +530,9 @@ class _LlamaBatch:
             self.batch.logits[i] = logits_all
         self.batch.logits[n_tokens - 1] = True
 
-    def add_sequence(self, batch: Sequence[int], seq_id: int, logits_all: bool):
+    def add_sequence(
+        self, batch: Sequence[int], seq_id: int, logits_all: bool, n_past: int = 0
+    ):
         assert self.batch is not None
         n_tokens = len(batch)
         n_tokens0 = self.batch.n_tokens
@@ -538,11 +540,11 @@ class _LlamaBatch:
         for i in range(n_tokens):
             j = n_tokens0 + i
             self.batch.token[j] = batch[i]
-            self.batch.pos[j] = i
+            self.batch.pos[j] = n_past + i
             self.batch.seq_id[j][0] = seq_id
             self.batch.n_seq_id[j] = 1
             self.batch.logits[j] = logits_all
-        self.batch.logits[n_tokens - 1] = True
+        self.batch.logits[n_tokens0 + n_tokens - 1] = True
 
 
 class _LlamaTokenDataArray:
@@ -554,7 +556,7 @@ class _LlamaTokenDataArray:
                 [("id", np.intc), ("logit", np.single), ("p", np.single)], align=True
             ),
         )
-        self.candidates_data.resize(3, self.n_vocab, refcheck=False)
+        self.candidates_data.resize(self.n_vocab, refcheck=False)
         self.candidates = llama_cpp.llama_token_data_array(
             data=self.candidates_data.ctypes.data_as(llama_cpp.llama_token_data_p),
             size=self.n_vocab,
@@ -687,6 +689,7 @@ class _LlamaSamplingContext:
     # NOTE: Missing parsed_grammar
     prev: list[int] = field(default_factory=list)
     cur: list[llama_cpp.llama_token_data] = field(default_factory=list)
+    token_data_array: Optional[_LlamaTokenDataArray] = field(default=None, repr=False)
 
     def reset(self):
         self.prev = []
@@ -712,12 +715,62 @@ class _LlamaSamplingContext:
     def prev_str(self, ctx_main: _LlamaContext, n: int) -> str:
         return ctx_main.model.detokenize(self.prev[-n:]).decode("utf-8")
 
+    def penalty_tokens(self) -> npt.NDArray[np.intc]:
+        # llama_sample_repetition_penalties reads penalty_last_n tokens from the pointer on, so it gets the tail of prev
+        if self.params.penalty_last_n <= 0 or len(self.prev) == 0:
+            return np.zeros(0, dtype=np.intc)
+        return np.ascontiguousarray(self.prev[-self.params.penalty_last_n :], dtype=np.intc)
+
+    def sample_greedy(
+        self, ctx_main: _LlamaContext, logits_array: npt.NDArray[np.single]
+    ) -> int:
+        """Argmax over the logits with the repetition penalties applied in place.
+
+        Only the logits of the penalized tokens are touched and they are
+        restored afterwards, so the logits array is neither copied nor
+        changed."""
+        last_tokens = self.penalty_tokens()
+        if len(last_tokens) == 0 or (
+            self.params.penalty_repeat == 1.0
+            and self.params.penalty_freq == 0.0
+            and self.params.penalty_present == 0.0
+        ):
+            return int(np.argmax(logits_array))
+        tokens, counts = np.unique(last_tokens, return_counts=True)
+        if not self.params.penalize_nl:
+            keep = tokens != ctx_main.model.token_nl()
+            tokens, counts = tokens[keep], counts[keep]
+        saved = logits_array[tokens]
+        penalized = np.where(
+            saved <= 0,
+            saved * self.params.penalty_repeat,
+            saved / self.params.penalty_repeat,
+        )
+        penalized -= counts * self.params.penalty_freq + self.params.penalty_present
+        logits_array[tokens] = penalized
+        id = int(np.argmax(logits_array))
+        logits_array[tokens] = saved
+        return id
+
     def sample(
         self, ctx_main: _LlamaContext, ctx_cfg: Optional[_LlamaContext] = None, idx: int = 0, logits_array: Optional[npt.NDArray[np.single]] = None
     ):
         n_vocab = ctx_main.model.n_vocab()
         id: int = 0
 
+        if (
+            self.params.temp == 0
+            and self.grammar is None
+            and ctx_cfg is None
+            and len(self.params.logit_bias) == 0
+        ):
+            # Greedy needs no candidate array, it works on a view of the logits
+            if logits_array is None:
+                logits_array = np.ctypeslib.as_array(
+                    ctx_main.get_logits_ith(idx), shape=(n_vocab,)
+                )
+            return self.sample_greedy(ctx_main, logits_array)
+
         if logits_array is None:
             logits = ctx_main.get_logits_ith(idx)
             logits_array = np.array(
@@ -729,9 +782,9 @@ class _LlamaSamplingContext:
         for token, logit_bias in self.params.logit_bias.items():
             logits_array[token] += logit_bias
 
-        token_data_array = _LlamaTokenDataArray(
-            n_vocab=n_vocab
-        )  # TODO: Only create this once
+        if self.token_data_array is None or self.token_data_array.n_vocab != n_vocab:
+            self.token_data_array = _LlamaTokenDataArray(n_vocab=n_vocab)
+        token_data_array = self.token_data_array
         token_data_array.copy_logits(logits_array)
 
         if ctx_cfg is not None:
@@ -743,12 +796,12 @@ class _LlamaSamplingContext:
         if len(self.prev) > 0:
             nl_token = ctx_main.model.token_nl()
             nl_logit = logits_array[nl_token]
-            if self.params.penalty_last_n > 0:
+            last_tokens = self.penalty_tokens()
+            if len(last_tokens) > 0:
                 ctx_main.sample_repetition_penalties(
                     token_data_array,
-                    # TODO: Only create this once
-                    (llama_cpp.llama_token * len(self.prev))(*self.prev),  # type: ignore
-                    self.params.penalty_last_n,
+                    last_tokens.ctypes.data_as(ctypes.POINTER(llama_cpp.llama_token)),  # type: ignore
+                    len(last_tokens),
                     self.params.penalty_repeat,
                     self.params.penalty_freq,
                     self.params.penalty_present,
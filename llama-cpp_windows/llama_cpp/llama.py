@@ -160,7 +160,7 @@ class Llama:
             yarn_beta_fast: YaRN low correction dim
             yarn_beta_slow: YaRN high correction dim
             yarn_orig_ctx: YaRN original context size
-            logits_all: Return logits for all tokens, not just the last token. Must be True for completion to return logprobs.
+            logits_all: Return logits for all tokens, not just the last token. Must be True for completion to return logprobs. Otherwise only the logits of the last evaluated token are kept.
             embedding: Embedding mode only.
             offload_kqv: Offload K, Q, V to GPU.
             last_n_tokens_size: Maximum number of tokens to keep in the last_n_tokens deque.
@@ -342,6 +342,10 @@ class Llama:
         self.chat_handler = chat_handler
 
         self.draft_model = draft_model
+        # Speculative decoding statistics of the last generate() call
+        self.n_draft_proposed = 0
+        self.n_draft_accepted = 0
+        self.n_generated = 0
 
         self._n_vocab = self.n_vocab()
         self._n_ctx = self.n_ctx()
@@ -353,13 +357,17 @@ class Llama:
 
         self.n_tokens = 0
         self.input_ids: npt.NDArray[np.intc] = np.ndarray((n_ctx,), dtype=np.intc)
+        # Without logits_all only the last token has logits, so only one row is kept
         self.scores: npt.NDArray[np.single] = np.ndarray(
-            (n_ctx, self._n_vocab), dtype=np.single
+            (n_ctx if self.context_params.logits_all else 1, self._n_vocab),
+            dtype=np.single,
         )
 
         self._mirostat_mu = ctypes.c_float(
             2.0 * 5.0
         )  # TODO: Move this to sampling context
+        self._sampling_context: Optional[_LlamaSamplingContext] = None
+        self._sampling_key: Optional[tuple] = None
 
         try:
             self.metadata = self._model.metadata()
@@ -422,6 +430,8 @@ class Llama:
 
     @property
     def _scores(self) -> npt.NDArray[np.single]:
+        if not self.context_params.logits_all:
+            return self.scores[: min(self.n_tokens, 1), :]
         return self.scores[: self.n_tokens, :]
 
     @property
@@ -431,7 +441,7 @@ class Llama:
     @property
     def eval_logits(self) -> Deque[List[float]]:
         return deque(
-            self.scores[: self.n_tokens, :].tolist(),
+            self._scores.tolist(),
             maxlen=self._n_ctx if self.context_params.logits_all else 1,
         )
 
@@ -503,15 +513,16 @@ class Llama:
             self._ctx.decode(self._batch)
             # Save tokens
             self.input_ids[n_past : n_past + n_tokens] = batch
-            # Save logits
-            rows = n_tokens
-            cols = self._n_vocab
-            offset = (
-                0 if self.context_params.logits_all else n_tokens - 1
-            )  # NOTE: Only save the last token logits if logits_all is False
-            self.scores[n_past + offset : n_past + n_tokens, :].reshape(-1)[
-                :
-            ] = self._ctx.get_logits()[offset * cols : rows * cols]
+            # Save logits, copied straight from a view of the context's logits buffer
+            if self.context_params.logits_all:
+                self.scores[n_past : n_past + n_tokens, :] = np.ctypeslib.as_array(
+                    self._ctx.get_logits(), shape=(n_tokens, self._n_vocab)
+                )
+            else:
+                # NOTE: Only the last token has logits if logits_all is False
+                self.scores[0, :] = np.ctypeslib.as_array(
+                    self._ctx.get_logits_ith(n_tokens - 1), shape=(self._n_vocab,)
+                )
             # Update n_tokens
             self.n_tokens += n_tokens
 
@@ -551,7 +562,8 @@ class Llama:
         if idx is None:
             logits: npt.NDArray[np.single] = self._scores[-1, :]
         else:
-            logits = self._scores[idx, :]
+            # Counted from the end, so it also works when only the last row is kept
+            logits = self._scores[idx - self.n_tokens, :]
 
         if logits_processor is not None:
             logits[:] = (
@@ -560,33 +572,53 @@ class Llama:
                 else logits_processor(self._input_ids[:idx + 1], logits)
             )
 
-        sampling_params = _LlamaSamplingParams(
-            top_k=top_k,
-            top_p=top_p,
-            min_p=min_p,
-            tfs_z=tfs_z,
-            typical_p=typical_p,
-            temp=temp,
-            penalty_last_n=self.last_n_tokens_size,
-            penalty_repeat=repeat_penalty,
-            penalty_freq=frequency_penalty,
-            penalty_present=presence_penalty,
-            mirostat=mirostat_mode,
-            mirostat_tau=mirostat_tau,
-            mirostat_eta=mirostat_eta,
-            penalize_nl=penalize_nl,
-        )
-        sampling_context = _LlamaSamplingContext(
-            params=sampling_params,
-            grammar=grammar,
+        # The sampling context lives as long as the parameters do, so the
+        # candidate buffer is allocated once per generation, not per token
+        sampling_key = (
+            top_k,
+            top_p,
+            min_p,
+            tfs_z,
+            typical_p,
+            temp,
+            self.last_n_tokens_size,
+            repeat_penalty,
+            frequency_penalty,
+            presence_penalty,
+            mirostat_mode,
+            mirostat_tau,
+            mirostat_eta,
+            penalize_nl,
         )
-        sampling_context.prev = list(self.eval_tokens)
+        if self._sampling_context is None or self._sampling_key != sampling_key:
+            self._sampling_context = _LlamaSamplingContext(
+                params=_LlamaSamplingParams(
+                    top_k=top_k,
+                    top_p=top_p,
+                    min_p=min_p,
+                    tfs_z=tfs_z,
+                    typical_p=typical_p,
+                    temp=temp,
+                    penalty_last_n=self.last_n_tokens_size,
+                    penalty_repeat=repeat_penalty,
+                    penalty_freq=frequency_penalty,
+                    penalty_present=presence_penalty,
+                    mirostat=mirostat_mode,
+                    mirostat_tau=mirostat_tau,
+                    mirostat_eta=mirostat_eta,
+                    penalize_nl=penalize_nl,
+                ),
+            )
+            self._sampling_key = sampling_key
+        sampling_context = self._sampling_context
+        sampling_context.grammar = grammar
+        sampling_context.mirostat_mu = self._mirostat_mu
+        # The penalty history is a view of the tokens up to the sampled position, input_ids already holds them
+        end = self.n_tokens if idx is None else idx + 1
+        sampling_context.prev = self.input_ids[max(end - self.last_n_tokens_size, 0) : end]  # type: ignore
         id = sampling_context.sample(ctx_main=self._ctx, logits_array=logits)
-        sampling_context.accept(
-            ctx_main=self._ctx,
-            id=id,
-            apply_grammar=grammar is not None,
-        )
+        if grammar is not None:
+            self._ctx.grammar_accept_token(grammar, id)
         return id
 
     def generate(
@@ -658,6 +690,10 @@ class Llama:
         sample_idx = self.n_tokens + len(tokens) - 1
         tokens = list(tokens)
 
+        self.n_draft_proposed = 0
+        self.n_draft_accepted = 0
+        self.n_generated = 0
+
         # Eval and sample
         while True:
             self.eval(tokens)
@@ -682,6 +718,7 @@ class Llama:
                 )
 
                 sample_idx += 1
+                self.n_generated += 1
                 if stopping_criteria is not None and stopping_criteria(
                     self._input_ids, self._scores[-1, :]
                 ):
@@ -692,19 +729,22 @@ class Llama:
                 if tokens_or_none is not None:
                     tokens.extend(tokens_or_none)
 
-                if sample_idx < self.n_tokens and token != self._input_ids[sample_idx]:
-                    self.n_tokens = sample_idx
-                    self._ctx.kv_cache_seq_rm(-1, self.n_tokens, -1)
-                    break
+                if sample_idx < self.n_tokens:
+                    # Positions past the sampled one hold draft tokens, the sample verifies the next one
+                    if token != self._input_ids[sample_idx]:
+                        self.n_tokens = sample_idx
+                        self._ctx.kv_cache_seq_rm(-1, self.n_tokens, -1)
+                        break
+                    self.n_draft_accepted += 1
 
             if self.draft_model is not None:
                 self.input_ids[self.n_tokens : self.n_tokens + len(tokens)] = tokens
                 draft_tokens = self.draft_model(self.input_ids[:self.n_tokens + len(tokens)])
-                tokens.extend(
-                    draft_tokens.astype(int)[
-                        : self._n_ctx - self.n_tokens - len(tokens)
-                    ]
-                )
+                draft_tokens = draft_tokens.astype(int)[
+                    : self._n_ctx - self.n_tokens - len(tokens)
+                ]
+                self.n_draft_proposed += len(draft_tokens)
+                tokens.extend(draft_tokens)
 
     def create_embedding(
         self, input: Union[str, List[str]], model: Optional[str] = None
@@ -751,11 +791,13 @@ class Llama:
         normalize: bool = True,
         truncate: bool = True,
         return_count: bool = False,
+        return_numpy: bool = False,
     ):
         """Embed a string.
 
         Args:
             input: The utf-8 encoded string to embed.
+            return_numpy: Return a float32 ndarray of shape (n_inputs, n_embd) instead of lists.
 
         Returns:
             A list of embeddings
@@ -781,21 +823,29 @@ class Llama:
         self._batch.reset()
 
         # decode and fetch embeddings
-        data: List[List[float]] = []
+        data: npt.NDArray[np.single] = np.empty((len(inputs), n_embd), dtype=np.single)
+        n_done = 0
         def decode_batch(sizes: List[int]):
+            nonlocal n_done
             assert self._ctx.ctx is not None
+            if len(sizes) == 0:
+                return
             llama_cpp.llama_kv_cache_clear(self._ctx.ctx)
             self._ctx.decode(self._batch)
             self._batch.reset()
 
-            # store embeddings
-            for i, s in enumerate(sizes):
-                embedding = llama_cpp.llama_get_embeddings_ith(self._ctx.ctx, i)[
-                    :n_embd
-                ]
-                norm = np.linalg.norm(embedding) if normalize else s
-                embedding: List[float] = [v / float(norm) for v in embedding]
-                data.append(embedding)
+            # copy embeddings straight from the context buffer
+            rows = data[n_done : n_done + len(sizes)]
+            for i in range(len(sizes)):
+                rows[i] = np.ctypeslib.as_array(
+                    llama_cpp.llama_get_embeddings_ith(self._ctx.ctx, i), shape=(n_embd,)
+                )
+            if normalize:
+                norms = np.linalg.norm(rows, axis=1, keepdims=True)
+                rows /= np.maximum(norms, np.finfo(np.single).tiny)
+            else:
+                rows /= np.array(sizes, dtype=np.single)[:, None]
+            n_done += len(sizes)
 
         # init state
         total_tokens = 0
@@ -834,7 +884,9 @@ class Llama:
         if self.verbose:
             llama_cpp.llama_print_timings(self._ctx.ctx)
 
-        output = data[0] if isinstance(input, str) else data
+        output = data if return_numpy else data.tolist()
+        if isinstance(input, str):
+            output = output[0]
 
         llama_cpp.llama_kv_cache_clear(self._ctx.ctx)
         self.reset()
@@ -1780,7 +1832,7 @@ class Llama:
                 file=sys.stderr,
             )
         return LlamaState(
-            scores=self.scores.copy(),
+            scores=self._scores.copy(),
             input_ids=self.input_ids.copy(),
             n_tokens=self.n_tokens,
             llama_state=bytes(llama_state_compact),
@@ -1789,7 +1841,15 @@ class Llama:
 
     def load_state(self, state: LlamaState) -> None:
         assert self._ctx.ctx is not None
-        self.scores = state.scores.copy()
+        # States only hold the rows that were in use, the rest of scores is stale anyway
+        n_rows = min(state.n_tokens, state.scores.shape[0])
+        if self.context_params.logits_all and state.scores.shape[0] >= state.n_tokens:
+            self.scores[:n_rows, :] = state.scores[:n_rows, :]
+        elif n_rows > 0:
+            # Only the last row is kept here, or only the last row was saved
+            self.scores[min(state.n_tokens, self.scores.shape[0]) - 1, :] = state.scores[
+                n_rows - 1, :
+            ]
         self.input_ids = state.input_ids.copy()
         self.n_tokens = state.n_tokens
         state_size = state.llama_state_size
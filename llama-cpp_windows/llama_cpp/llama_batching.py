@@ -0,0 +1,572 @@
+from __future__ import annotations
+
+import sys
+import time
+import uuid
+import queue
+import ctypes
+import threading
+from collections import deque
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Union,
+)
+
+import llama_cpp.llama
+import llama_cpp.llama_chat_format as llama_chat_format
+
+from .llama_types import *
+
+from ._internals import (
+    _LlamaBatch,  # type: ignore
+    _LlamaSamplingParams,  # type: ignore
+    _LlamaSamplingContext,  # type: ignore
+)
+
+
+class LlamaBatchRequest:
+    """A completion submitted to a LlamaBatchScheduler.
+
+    Iterating over the request yields the generated token ids as soon as
+    they are sampled. The iterator ends on eos, max_tokens, the slot context
+    limit or after cancel() was called, finish_reason tells which."""
+
+    def __init__(
+        self,
+        tokens: List[int],
+        max_tokens: int,
+        sampling_params: _LlamaSamplingParams,
+    ):
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+        self.sampling_params = sampling_params
+        self.cancelled = False
+        self.finish_reason: Optional[str] = None
+        self.n_generated = 0
+        self._queue: "queue.Queue[Union[int, Exception, None]]" = queue.Queue()
+
+    def cancel(self):
+        """Stop generating, the slot is freed on the next decode step."""
+        self.cancelled = True
+
+    def __iter__(self) -> Iterator[int]:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            self.n_generated += 1
+            yield item
+
+
+class _LlamaBatchSlot:
+    """One sequence of the shared context, owning the KV cells of its seq_id."""
+
+    def __init__(self, seq_id: int):
+        self.seq_id = seq_id
+        self.request: Optional[LlamaBatchRequest] = None
+        self.sampling_context: Optional[_LlamaSamplingContext] = None
+        self.pending: List[int] = []  # tokens that still have to be decoded
+        self.n_past = 0
+        self.n_generated = 0
+
+
+class LlamaBatchScheduler:
+    """Continuous batching of concurrent completions on a single Llama context.
+
+    Every active request owns a slot with its own seq_id, so its KV cache
+    region lives next to the others in the shared context. Each decode step
+    packs the next token of every generating slot together with as much
+    pending prompt as fits into n_batch, decodes them in one llama_decode
+    call and samples every finished slot from its own batch position.
+    Requests join and leave between steps, so a new prompt never waits for
+    the running generations to finish.
+
+    The scheduler takes over the context of the Llama instance; the model
+    must not be evaluated directly while the scheduler is running.
+    create_completion and create_chat_completion return the same objects as
+    the Llama methods, so the server hands requests to the scheduler instead
+    of the model when ModelSettings.n_slots is above 1."""
+
+    def __init__(
+        self,
+        model: llama_cpp.llama.Llama,
+        n_slots: int = 4,
+        verbose: bool = False,
+    ):
+        """Create a scheduler.
+
+        Args:
+            model: The Llama instance whose context is shared by all slots.
+            n_slots: Number of sequences decoded together. The context is split evenly between them.
+            verbose: Print per-request and throughput statistics to stderr.
+        """
+        assert n_slots > 0
+        self.model = model
+        self.n_slots = n_slots
+        self.verbose = verbose
+        self.n_batch = model.n_batch
+        self.n_ctx_slot = model.n_ctx() // n_slots
+
+        self._batch = _LlamaBatch(
+            n_tokens=self.n_batch, embd=0, n_seq_max=1, verbose=model.verbose
+        )
+        self._slots = [_LlamaBatchSlot(seq_id) for seq_id in range(n_slots)]
+        self._waiting: Deque[LlamaBatchRequest] = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+        self.n_steps = 0
+        self.n_tokens_decoded = 0
+        self.n_tokens_generated = 0
+        self.t_decode = 0.0
+
+        model.reset()
+        model._ctx.kv_cache_clear()
+
+    def submit(
+        self,
+        prompt: Union[str, Sequence[int]],
+        max_tokens: int = 16,
+        temperature: float = 0.8,
+        top_k: int = 40,
+        top_p: float = 0.95,
+        min_p: float = 0.05,
+        typical_p: float = 1.0,
+        tfs_z: float = 1.0,
+        repeat_penalty: float = 1.1,
+        frequency_penalty: float = 0.0,
+        presence_penalty: float = 0.0,
+        mirostat_mode: int = 0,
+        mirostat_tau: float = 5.0,
+        mirostat_eta: float = 0.1,
+    ) -> LlamaBatchRequest:
+        """Queue a completion and return it immediately.
+
+        Args:
+            prompt: The prompt as text or as token ids.
+            max_tokens: The maximum number of tokens to generate.
+            temperature: The temperature, 0 samples greedily.
+            mirostat_mode: The mirostat sampling mode, every slot keeps its own mu.
+
+        Raises:
+            ValueError: If the prompt does not fit into a slot.
+
+        Returns:
+            The request, iterate over it to receive the generated tokens.
+        """
+        if isinstance(prompt, str):
+            tokens = self.model.tokenize(prompt.encode("utf-8"), special=True)
+        else:
+            tokens = list(prompt)
+        if len(tokens) == 0 or len(tokens) >= self.n_ctx_slot:
+            # same wording as Llama, the server maps it to context_length_exceeded
+            raise ValueError(
+                f"Requested tokens ({len(tokens)}) exceed context window of {self.n_ctx_slot}"
+            )
+
+        request = LlamaBatchRequest(
+            tokens=tokens,
+            max_tokens=max_tokens,
+            sampling_params=_LlamaSamplingParams(
+                top_k=top_k,
+                top_p=top_p,
+                min_p=min_p,
+                tfs_z=tfs_z,
+                typical_p=typical_p,
+                temp=temperature,
+                penalty_last_n=self.model.last_n_tokens_size,
+                penalty_repeat=repeat_penalty,
+                penalty_freq=frequency_penalty,
+                penalty_present=presence_penalty,
+                mirostat=mirostat_mode,
+                mirostat_tau=mirostat_tau,
+                mirostat_eta=mirostat_eta,
+            ),
+        )
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("LlamaBatchScheduler is closed")
+            self._waiting.append(request)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return request
+
+    def complete(
+        self,
+        prompt: Union[str, Sequence[int]],
+        stop: Optional[Union[str, List[str]]] = None,
+        **kwargs,
+    ) -> str:
+        """Generate a completion and block until it is finished.
+
+        Args:
+            prompt: The prompt as text or as token ids.
+            stop: Strings that end the completion, they are not included in the result.
+            **kwargs: Passed on to submit().
+
+        Returns:
+            The generated text.
+        """
+        stop_sequences = [stop] if isinstance(stop, str) else (stop or [])
+        request = self.submit(prompt, **kwargs)
+        return "".join(self._completion_text(request, stop_sequences))
+
+    def tokenize(
+        self, text: bytes, add_bos: bool = True, special: bool = False
+    ) -> List[int]:
+        """Tokenize with the model, this does not touch the shared context."""
+        return self.model.tokenize(text, add_bos, special)
+
+    def detokenize(self, tokens: List[int]) -> bytes:
+        """Detokenize with the model, this does not touch the shared context."""
+        return self.model.detokenize(tokens)
+
+    def __call__(self, *args, **kwargs):
+        """Same as create_completion, like Llama.__call__."""
+        return self.create_completion(*args, **kwargs)
+
+    def create_completion(
+        self,
+        prompt: Union[str, List[int]],
+        suffix: Optional[str] = None,
+        max_tokens: Optional[int] = 16,
+        temperature: float = 0.8,
+        top_p: float = 0.95,
+        min_p: float = 0.05,
+        typical_p: float = 1.0,
+        logprobs: Optional[int] = None,
+        echo: bool = False,
+        stop: Optional[Union[str, List[str]]] = [],
+        frequency_penalty: float = 0.0,
+        presence_penalty: float = 0.0,
+        repeat_penalty: float = 1.1,
+        top_k: int = 40,
+        stream: bool = False,
+        seed: Optional[int] = None,
+        tfs_z: float = 1.0,
+        mirostat_mode: int = 0,
+        mirostat_tau: float = 5.0,
+        mirostat_eta: float = 0.1,
+        model: Optional[str] = None,
+        stopping_criteria: Optional[llama_cpp.llama.StoppingCriteriaList] = None,
+        logits_processor: Optional[llama_cpp.llama.LogitsProcessorList] = None,
+        grammar: Optional[llama_cpp.llama.LlamaGrammar] = None,
+        logit_bias: Optional[Dict[str, float]] = None,
+    ) -> Union[CreateCompletionResponse, Iterator[CreateCompletionStreamResponse]]:
+        """Generate text from a prompt in one of the slots.
+
+        Takes the arguments of Llama.create_completion. The options that need
+        the whole context or a per-request sampler (suffix, echo, logprobs,
+        seed, grammar, logit bias, logits processors and stopping criteria)
+        are not available in a shared slot.
+
+        Raises:
+            ValueError: If an unsupported option is set or the prompt does not fit into a slot.
+
+        Returns:
+            Response object containing the generated text, or a stream of chunks.
+        """
+        unsupported = [
+            name
+            for name, value in (
+                ("suffix", suffix),
+                ("logprobs", logprobs),
+                ("seed", seed),
+                ("stopping_criteria", stopping_criteria),
+                ("logits_processor", logits_processor),
+                ("grammar", grammar),
+                ("logit_bias", logit_bias),
+            )
+            if value is not None
+        ]
+        if echo:
+            unsupported.append("echo")
+        if len(unsupported) > 0:
+            raise ValueError(
+                f"{', '.join(unsupported)} not supported with continuous batching (n_slots > 1)"
+            )
+
+        request = self.submit(
+            prompt,
+            max_tokens=max_tokens
+            if max_tokens is not None and max_tokens > 0
+            else self.n_ctx_slot,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            min_p=min_p,
+            typical_p=typical_p,
+            tfs_z=tfs_z,
+            repeat_penalty=repeat_penalty,
+            frequency_penalty=frequency_penalty,
+            presence_penalty=presence_penalty,
+            mirostat_mode=mirostat_mode,
+            mirostat_tau=mirostat_tau,
+            mirostat_eta=mirostat_eta,
+        )
+        completion_id = f"cmpl-{str(uuid.uuid4())}"
+        created = int(time.time())
+        model_name = model if model is not None else self.model.model_path
+        stop_sequences = [stop] if isinstance(stop, str) else (stop or [])
+        if stream:
+            return self._stream_completion(
+                request, stop_sequences, completion_id, created, model_name
+            )
+
+        text = "".join(self._completion_text(request, stop_sequences))
+        return {
+            "id": completion_id,
+            "object": "text_completion",
+            "created": created,
+            "model": model_name,
+            "choices": [
+                {
+                    "text": text,
+                    "index": 0,
+                    "logprobs": None,
+                    "finish_reason": request.finish_reason,  # type: ignore
+                }
+            ],
+            "usage": {
+                "prompt_tokens": len(request.tokens),
+                "completion_tokens": request.n_generated,
+                "total_tokens": len(request.tokens) + request.n_generated,
+            },
+        }
+
+    def create_chat_completion(
+        self, messages: List[ChatCompletionRequestMessage], **kwargs: Any
+    ) -> Union[
+        CreateChatCompletionResponse, Iterator[CreateChatCompletionStreamResponse]
+    ]:
+        """Generate a chat completion in one of the slots.
+
+        Takes the arguments of Llama.create_chat_completion. The prompt is
+        built by the chat format of the model, formats that drive the model
+        themselves (functionary, llava) need the Llama instance instead.
+
+        Returns:
+            Generated chat completion or a stream of chat completion chunks.
+        """
+        handler = (
+            self.model.chat_handler
+            or llama_chat_format.get_chat_completion_handler(self.model.chat_format)
+        )
+        return handler(llama=self, messages=messages, **kwargs)  # type: ignore
+
+    def _stream_completion(
+        self,
+        request: LlamaBatchRequest,
+        stop: List[str],
+        completion_id: str,
+        created: int,
+        model_name: str,
+    ) -> Iterator[CreateCompletionStreamResponse]:
+        for text in self._completion_text(request, stop):
+            yield {
+                "id": completion_id,
+                "object": "text_completion",
+                "created": created,
+                "model": model_name,
+                "choices": [
+                    {
+                        "text": text,
+                        "index": 0,
+                        "logprobs": None,
+                        "finish_reason": None,
+                    }
+                ],
+            }
+        yield {
+            "id": completion_id,
+            "object": "text_completion",
+            "created": created,
+            "model": model_name,
+            "choices": [
+                {
+                    "text": "",
+                    "index": 0,
+                    "logprobs": None,
+                    "finish_reason": request.finish_reason,  # type: ignore
+                }
+            ],
+        }
+
+    def _completion_text(
+        self, request: LlamaBatchRequest, stop: List[str]
+    ) -> Iterator[str]:
+        # yields the text as it grows, a tail that may still turn into a stop sequence is held back
+        completion_bytes = b""
+        returned = 0
+        try:
+            for token in request:
+                completion_bytes += self.model.detokenize([token])
+                text = completion_bytes.decode("utf-8", errors="ignore")
+                stop_positions = [text.find(s) for s in stop if s in text]
+                if len(stop_positions) > 0:
+                    request.finish_reason = "stop"
+                    end = min(stop_positions)
+                    if end > returned:
+                        yield text[returned:end]
+                    return
+                hold = max(
+                    (
+                        k
+                        for s in stop
+                        for k in range(1, len(s))
+                        if text.endswith(s[:k])
+                    ),
+                    default=0,
+                )
+                if len(text) - hold > returned:
+                    yield text[returned : len(text) - hold]
+                    returned = len(text) - hold
+            text = completion_bytes.decode("utf-8", errors="ignore")
+            if len(text) > returned:
+                yield text[returned:]
+        finally:
+            # on a stop sequence or a client that went away the slot is freed on the next step
+            request.cancel()
+
+    def close(self):
+        """Stop the scheduler thread and end all queued and running requests."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def tokens_per_second(self) -> float:
+        """Aggregate generated tokens per second of decode time."""
+        return self.n_tokens_generated / self.t_decode if self.t_decode > 0 else 0.0
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while (
+                    not self._closed
+                    and not self._waiting
+                    and all(slot.request is None for slot in self._slots)
+                ):
+                    self._cond.wait()
+                if self._closed:
+                    break
+                self._admit()
+            try:
+                self._step()
+            except Exception as e:
+                for slot in self._slots:
+                    if slot.request is not None:
+                        self._finish(slot, e)
+
+        for slot in self._slots:
+            if slot.request is not None:
+                self._finish(slot)
+        while self._waiting:
+            self._waiting.popleft()._queue.put(None)
+
+    def _admit(self):
+        for slot in self._slots:
+            if not self._waiting:
+                return
+            if slot.request is not None:
+                continue
+            request = self._waiting.popleft()
+            slot.request = request
+            slot.sampling_context = _LlamaSamplingContext(
+                params=request.sampling_params
+            )
+            slot.sampling_context.prev = request.tokens[-self.model.last_n_tokens_size :]
+            slot.sampling_context.mirostat_mu = ctypes.c_float(
+                2.0 * request.sampling_params.mirostat_tau
+            )
+            slot.pending = list(request.tokens)
+            slot.n_past = 0
+            slot.n_generated = 0
+
+    def _finish(
+        self,
+        slot: _LlamaBatchSlot,
+        error: Optional[Exception] = None,
+        finish_reason: str = "stop",
+    ):
+        assert slot.request is not None
+        self.model._ctx.kv_cache_seq_rm(slot.seq_id, -1, -1)
+        if slot.request.finish_reason is None:
+            slot.request.finish_reason = finish_reason
+        slot.request._queue.put(error)
+        if self.verbose:
+            print(
+                f"LlamaBatchScheduler: seq {slot.seq_id} finished, "
+                f"{slot.n_generated} tokens, {self.tokens_per_second:.1f} tokens/s aggregate",
+                file=sys.stderr,
+            )
+        slot.request = None
+        slot.sampling_context = None
+        slot.pending = []
+
+    def _step(self):
+        for slot in self._slots:
+            if slot.request is not None and slot.request.cancelled:
+                self._finish(slot)
+
+        # generating slots need a single token each and go first, prompts fill the rest
+        active = [slot for slot in self._slots if slot.request is not None]
+        active.sort(key=lambda slot: len(slot.pending))
+        if not active:
+            return
+
+        self._batch.reset()
+        sample_at = []
+        n_free = self.n_batch
+        for slot in active:
+            if n_free == 0:
+                break
+            chunk = slot.pending[:n_free]
+            self._batch.add_sequence(chunk, slot.seq_id, False, n_past=slot.n_past)
+            del slot.pending[: len(chunk)]
+            slot.n_past += len(chunk)
+            n_free -= len(chunk)
+            if not slot.pending:
+                sample_at.append((slot, self._batch.n_tokens() - 1))
+
+        t0 = time.perf_counter()
+        self.model._ctx.decode(self._batch)
+        self.t_decode += time.perf_counter() - t0
+        self.n_steps += 1
+        self.n_tokens_decoded += self._batch.n_tokens()
+
+        eos = self.model.token_eos()
+        for slot, idx in sample_at:
+            sampling_context = slot.sampling_context
+            assert slot.request is not None and sampling_context is not None
+            token = sampling_context.sample(ctx_main=self.model._ctx, idx=idx)
+            sampling_context.accept(self.model._ctx, token, apply_grammar=False)
+            del sampling_context.prev[: -self.model.last_n_tokens_size]
+            slot.n_generated += 1
+            self.n_tokens_generated += 1
+
+            if token == eos:
+                self._finish(slot)
+                continue
+            slot.request._queue.put(token)
+            if (
+                slot.n_generated >= slot.request.max_tokens
+                or slot.n_past + 1 >= self.n_ctx_slot
+            ):
+                self._finish(slot, finish_reason="length")
+                continue
+            slot.pending = [token]
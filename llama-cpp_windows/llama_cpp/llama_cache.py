@@ -1,13 +1,21 @@
+import os
 import sys
+import json
+import mmap
+import hashlib
 from abc import ABC, abstractmethod
 from typing import (
+    Any,
+    Dict,
+    List,
     Optional,
     Sequence,
     Tuple,
+    Union,
 )
 from collections import OrderedDict
 
-import diskcache
+import numpy as np
 
 import llama_cpp.llama
 
@@ -19,12 +27,32 @@ class BaseLlamaCache(ABC):
 
     def __init__(self, capacity_bytes: int = (2 << 30)):
         self.capacity_bytes = capacity_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     @property
     @abstractmethod
     def cache_size(self) -> int:
         raise NotImplementedError
 
+    @abstractmethod
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    @property
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Hit rate, size and eviction counters of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "entries": len(self),
+            "bytes": self.cache_size,
+            "evictions": self.evictions,
+        }
+
     def _find_longest_prefix_key(
         self,
         key: Tuple[int, ...],
@@ -44,6 +72,76 @@ class BaseLlamaCache(ABC):
         raise NotImplementedError
 
 
+class _LlamaTokenTrieNode:
+    __slots__ = ("children", "key", "n_keys")
+
+    def __init__(self):
+        self.children: Dict[int, "_LlamaTokenTrieNode"] = {}
+        self.key: Optional[Tuple[int, ...]] = None
+        self.n_keys = 0
+
+
+class _LlamaTokenTrie:
+    """Token-prefix trie over the keys of a cache.
+
+    Finding the key that shares the longest prefix with a query walks the
+    query once and then descends to any key below the deepest matching node,
+    so the cost depends on the key length and not on the number of keys."""
+
+    def __init__(self):
+        self.root = _LlamaTokenTrieNode()
+
+    def insert(self, key: Tuple[int, ...]):
+        path = [self.root]
+        node = self.root
+        for token in key:
+            child = node.children.get(token)
+            if child is None:
+                child = _LlamaTokenTrieNode()
+                node.children[token] = child
+            node = child
+            path.append(node)
+        if node.key is not None:
+            return
+        node.key = key
+        for n in path:
+            n.n_keys += 1
+
+    def remove(self, key: Tuple[int, ...]):
+        path = [self.root]
+        node = self.root
+        for token in key:
+            node = node.children.get(token)
+            if node is None:
+                return
+            path.append(node)
+        if node.key is None:
+            return
+        node.key = None
+        for n in path:
+            n.n_keys -= 1
+        # prune the branch that no longer leads to any key
+        for depth in range(1, len(key) + 1):
+            if path[depth].n_keys == 0:
+                del path[depth - 1].children[key[depth - 1]]
+                break
+
+    def longest_prefix_key(self, key: Sequence[int]) -> Optional[Tuple[int, ...]]:
+        node = self.root
+        depth = 0
+        for token in key:
+            child = node.children.get(token)
+            if child is None:
+                break
+            node = child
+            depth += 1
+        if depth == 0:
+            return None
+        while node.key is None:
+            node = next(iter(node.children.values()))
+        return node.key
+
+
 class LlamaRAMCache(BaseLlamaCache):
     """Cache for a llama.cpp model using RAM."""
 
@@ -51,31 +149,29 @@ class LlamaRAMCache(BaseLlamaCache):
         super().__init__(capacity_bytes)
         self.capacity_bytes = capacity_bytes
         self.cache_state: OrderedDict[Tuple[int, ...], "llama_cpp.llama.LlamaState"] = OrderedDict()
+        self._trie = _LlamaTokenTrie()
+        self._cache_size = 0
 
     @property
     def cache_size(self):
-        return sum([state.llama_state_size for state in self.cache_state.values()])
+        return self._cache_size
+
+    def __len__(self) -> int:
+        return len(self.cache_state)
 
     def _find_longest_prefix_key(
         self,
         key: Tuple[int, ...],
     ) -> Optional[Tuple[int, ...]]:
-        min_len = 0
-        min_key = None
-        keys = (
-            (k, llama_cpp.llama.Llama.longest_token_prefix(k, key)) for k in self.cache_state.keys()
-        )
-        for k, prefix_len in keys:
-            if prefix_len > min_len:
-                min_len = prefix_len
-                min_key = k
-        return min_key
+        return self._trie.longest_prefix_key(key)
 
     def __getitem__(self, key: Sequence[int]) -> "llama_cpp.llama.LlamaState":
         key = tuple(key)
         _key = self._find_longest_prefix_key(key)
         if _key is None:
+            self.misses += 1
             raise KeyError("Key not found")
+        self.hits += 1
         value = self.cache_state[_key]
         self.cache_state.move_to_end(_key)
         return value
@@ -86,10 +182,16 @@ class LlamaRAMCache(BaseLlamaCache):
     def __setitem__(self, key: Sequence[int], value: "llama_cpp.llama.LlamaState"):
         key = tuple(key)
         if key in self.cache_state:
-            del self.cache_state[key]
+            self._cache_size -= self.cache_state.pop(key).llama_state_size
+        else:
+            self._trie.insert(key)
         self.cache_state[key] = value
-        while self.cache_size > self.capacity_bytes and len(self.cache_state) > 0:
-            self.cache_state.popitem(last=False)
+        self._cache_size += value.llama_state_size
+        while self._cache_size > self.capacity_bytes and len(self.cache_state) > 0:
+            evicted_key, evicted = self.cache_state.popitem(last=False)
+            self._trie.remove(evicted_key)
+            self._cache_size -= evicted.llama_state_size
+            self.evictions += 1
 
 
 # Alias for backwards compatibility
@@ -97,54 +199,155 @@ LlamaCache = LlamaRAMCache
 
 
 class LlamaDiskCache(BaseLlamaCache):
-    """Cache for a llama.cpp model using disk."""
+    """Persistent cache for a llama.cpp model using disk.
+
+    Every state is written to its own blob file that is memory-mapped on a hit.
+    A sidecar index keeps the token keys in LRU order, so the cache survives a
+    restart of the process and lookups never have to touch the blobs."""
+
+    _index_file = "index.json"
 
     def __init__(
         self, cache_dir: str = ".cache/llama_cache", capacity_bytes: int = (2 << 30)
     ):
         super().__init__(capacity_bytes)
-        self.cache = diskcache.Cache(cache_dir)
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.cache_entries: OrderedDict[Tuple[int, ...], Dict[str, Any]] = OrderedDict()
+        self._trie = _LlamaTokenTrie()
+        self._cache_size = 0
+        self._load_index()
 
     @property
     def cache_size(self):
-        return int(self.cache.volume())  # type: ignore
+        return self._cache_size
+
+    def __len__(self) -> int:
+        return len(self.cache_entries)
+
+    def _path(self, entry_id: str, suffix: str) -> str:
+        return os.path.join(self.cache_dir, f"{entry_id}{suffix}")
+
+    @staticmethod
+    def _entry_id(key: Tuple[int, ...]) -> str:
+        return hashlib.sha1(np.asarray(key, dtype=np.intc).tobytes()).hexdigest()
+
+    def _load_index(self):
+        index_path = os.path.join(self.cache_dir, self._index_file)
+        entries: List[Dict[str, Any]] = []
+        if os.path.isfile(index_path):
+            try:
+                with open(index_path, "r") as f:
+                    entries = json.load(f)["entries"]
+            except (OSError, ValueError, KeyError):
+                print(f"LlamaDiskCache: ignoring unreadable index {index_path}", file=sys.stderr)
+                entries = []
+        for entry in entries:
+            if not os.path.isfile(self._path(entry["id"], ".state")):
+                continue
+            key = tuple(entry["key"])
+            self.cache_entries[key] = entry
+            self._trie.insert(key)
+            self._cache_size += entry["llama_state_size"]
+        # drop blobs left behind by a crash or by a file that was still mapped on eviction
+        known = {entry["id"] for entry in self.cache_entries.values()}
+        for name in os.listdir(self.cache_dir):
+            entry_id, ext = os.path.splitext(name)
+            if ext in (".state", ".npz") and entry_id not in known:
+                self._remove_file(os.path.join(self.cache_dir, name))
+
+    def _save_index(self):
+        index_path = os.path.join(self.cache_dir, self._index_file)
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"entries": list(self.cache_entries.values())}, f)
+        os.replace(tmp_path, index_path)
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            # still mapped by a live LlamaState (Windows), cleaned up on the next load
+            pass
 
     def _find_longest_prefix_key(
         self,
         key: Tuple[int, ...],
     ) -> Optional[Tuple[int, ...]]:
-        min_len = 0
-        min_key: Optional[Tuple[int, ...]] = None
-        for k in self.cache.iterkeys():  # type: ignore
-            prefix_len = llama_cpp.llama.Llama.longest_token_prefix(k, key)
-            if prefix_len > min_len:
-                min_len = prefix_len
-                min_key = k  # type: ignore
-        return min_key
+        return self._trie.longest_prefix_key(key)
+
+    def _read_state(self, entry: Dict[str, Any]) -> "llama_cpp.llama.LlamaState":
+        with np.load(self._path(entry["id"], ".npz")) as data:
+            input_ids = np.zeros(entry["input_ids_len"], dtype=np.intc)
+            input_ids[: entry["n_tokens"]] = data["input_ids"]
+            scores = np.zeros(tuple(entry["scores_shape"]), dtype=np.single)
+            if entry["scores_row"] >= 0:
+                scores[entry["scores_row"], :] = data["scores_row"]
+        with open(self._path(entry["id"], ".state"), "rb") as f:
+            llama_state = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return llama_cpp.llama.LlamaState(
+            input_ids=input_ids,
+            scores=scores,
+            n_tokens=entry["n_tokens"],
+            llama_state=llama_state,  # type: ignore
+            llama_state_size=entry["llama_state_size"],
+        )
+
+    def _write_state(self, entry_id: str, value: "llama_cpp.llama.LlamaState"):
+        # only the last evaluated row of the scores is ever read back after a restore
+        scores_row = min(value.n_tokens, value.scores.shape[0]) - 1
+        npz_path = self._path(entry_id, ".npz")
+        with open(f"{npz_path}.tmp", "wb") as f:
+            np.savez(
+                f,
+                input_ids=value.input_ids[: value.n_tokens],
+                scores_row=value.scores[max(scores_row, 0), :],
+            )
+        state_path = self._path(entry_id, ".state")
+        with open(f"{state_path}.tmp", "wb") as f:
+            f.write(memoryview(value.llama_state)[: value.llama_state_size])
+        os.replace(f"{npz_path}.tmp", npz_path)
+        os.replace(f"{state_path}.tmp", state_path)
+        return {
+            "id": entry_id,
+            "n_tokens": value.n_tokens,
+            "input_ids_len": int(value.input_ids.shape[0]),
+            "scores_shape": list(value.scores.shape),
+            "scores_row": scores_row,
+            "llama_state_size": value.llama_state_size,
+        }
 
     def __getitem__(self, key: Sequence[int]) -> "llama_cpp.llama.LlamaState":
         key = tuple(key)
         _key = self._find_longest_prefix_key(key)
         if _key is None:
+            self.misses += 1
             raise KeyError("Key not found")
-        value: "llama_cpp.llama.LlamaState" = self.cache.pop(_key)  # type: ignore
-        # NOTE: This puts an integer as key in cache, which breaks,
-        # Llama.longest_token_prefix(k, key) above since k is not a tuple of ints/tokens
-        # self.cache.push(_key, side="front")  # type: ignore
+        self.hits += 1
+        value = self._read_state(self.cache_entries[_key])
+        # the new LRU order reaches the index with the next write, a read never rewrites it
+        self.cache_entries.move_to_end(_key)
         return value
 
     def __contains__(self, key: Sequence[int]) -> bool:
         return self._find_longest_prefix_key(tuple(key)) is not None
 
     def __setitem__(self, key: Sequence[int], value: "llama_cpp.llama.LlamaState"):
-        print("LlamaDiskCache.__setitem__: called", file=sys.stderr)
         key = tuple(key)
-        if key in self.cache:
-            print("LlamaDiskCache.__setitem__: delete", file=sys.stderr)
-            del self.cache[key]
-        self.cache[key] = value
-        print("LlamaDiskCache.__setitem__: set", file=sys.stderr)
-        while self.cache_size > self.capacity_bytes and len(self.cache) > 0:
-            key_to_remove = next(iter(self.cache))
-            del self.cache[key_to_remove]
-        print("LlamaDiskCache.__setitem__: trim", file=sys.stderr)
+        if key in self.cache_entries:
+            self._cache_size -= self.cache_entries.pop(key)["llama_state_size"]
+        else:
+            self._trie.insert(key)
+        entry = self._write_state(self._entry_id(key), value)
+        entry["key"] = list(key)
+        self.cache_entries[key] = entry
+        self._cache_size += entry["llama_state_size"]
+        while self._cache_size > self.capacity_bytes and len(self.cache_entries) > 0:
+            evicted_key, evicted = self.cache_entries.popitem(last=False)
+            self._trie.remove(evicted_key)
+            self._cache_size -= evicted["llama_state_size"]
+            self._remove_file(self._path(evicted["id"], ".state"))
+            self._remove_file(self._path(evicted["id"], ".npz"))
+            self.evictions += 1
+        self._save_index()
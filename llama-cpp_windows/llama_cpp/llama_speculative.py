@@ -1,6 +1,6 @@
 import abc
 
-from typing import Any
+from typing import Any, Dict, List, Tuple
 
 import numpy as np
 import numpy.typing as npt
@@ -28,30 +28,29 @@ class LlamaPromptLookupDecoding(LlamaDraftModel):
         num_pred_tokens: int,
     ):
         input_length = input_ids.shape[0]
+        max_ngram_size = min(max_ngram_size, input_length - 1)
+        if max_ngram_size < 1:
+            return np.array([], dtype=np.intc)
+
+        # End positions of every earlier occurrence of the last token. Each
+        # longer ngram only narrows the previous candidates down, so no
+        # window matrix is built and the work stays linear in the input.
+        ends = np.flatnonzero(input_ids[:-1] == input_ids[-1])
+        candidates = [ends]
+        for ngram_size in range(2, max_ngram_size + 1):
+            ends = ends[ends >= ngram_size - 1]
+            ends = ends[input_ids[ends - (ngram_size - 1)] == input_ids[-ngram_size]]
+            if len(ends) == 0:
+                break
+            candidates.append(ends)
+
+        # Longest ngram first, the earliest occurrence wins. Every candidate
+        # ends before the last token, so its continuation is never empty.
+        for ends in reversed(candidates):
+            if len(ends) > 0:
+                start_idx = ends[0] + 1
+                return input_ids[start_idx : min(start_idx + num_pred_tokens, input_length)]
 
-        for ngram_size in range(min(max_ngram_size, input_length - 1), 0, -1):
-            # Create sliding windows of size ngram_size
-            windows = np.lib.stride_tricks.sliding_window_view(input_ids, (ngram_size,))
-
-            # Convert ngram to an array for comparison
-            ngram_array = input_ids[-ngram_size:]
-
-            # Find where the windows match the ngram
-            matches = np.all(windows == ngram_array, axis=1)
-
-            # Get the indices of matches
-            match_indices = np.nonzero(matches)[0]
-
-            # Iterate through match indices to find a valid continuation
-            for idx in match_indices:
-                start_idx = idx + ngram_size
-                end_idx = start_idx + num_pred_tokens
-                end_idx = min(end_idx, input_length)
-
-                if start_idx < end_idx:
-                    return input_ids[start_idx:end_idx]
-
-        # If no match is found, return an empty array
         return np.array([], dtype=np.intc)
 
     def __call__(
@@ -62,3 +61,78 @@ class LlamaPromptLookupDecoding(LlamaDraftModel):
             max_ngram_size=self.max_ngram_size,
             num_pred_tokens=self.num_pred_tokens,
         )
+
+
+class LlamaPromptLookupIndex(LlamaDraftModel):
+    """Prompt lookup decoding backed by an incremental n-gram index.
+
+    Keeps a hash map per n-gram size from n-gram to the latest position
+    it ended at, only extended with the tokens that were appended since the
+    last call. A draft costs one dictionary lookup per n-gram size, longest
+    first, no matter how long the context is. If the input no longer starts
+    with the tokens seen so far (new prompt, rolled back tokens) the index
+    starts over."""
+
+    def __init__(
+        self,
+        max_ngram_size: int = 3,
+        num_pred_tokens: int = 10,
+        min_ngram_size: int = 1,
+    ):
+        assert 1 <= min_ngram_size <= max_ngram_size
+        self.max_ngram_size = max_ngram_size
+        self.min_ngram_size = min_ngram_size
+        self.num_pred_tokens = num_pred_tokens
+        self._input_ids = np.zeros(0, dtype=np.intc)
+        self._n_tokens = 0
+        self._index: List[Dict[Tuple[int, ...], int]] = [
+            {} for _ in range(max_ngram_size + 1)
+        ]
+        # Positions up to here already have their n-grams in the index
+        self._n_indexed = 0
+
+    def reset(self):
+        self._n_tokens = 0
+        self._n_indexed = 0
+        for index in self._index:
+            index.clear()
+
+    def _sync(self, input_ids: npt.NDArray[np.intc]):
+        n_common = min(self._n_tokens, input_ids.shape[0])
+        # A plain memcmp, the Python side work below only depends on the new tokens
+        if not np.array_equal(self._input_ids[:n_common], input_ids[:n_common]) or (
+            self._n_indexed > max(n_common - 1, 0)
+        ):
+            # The n-grams of dropped tokens can not be taken out one by one, start over
+            self.reset()
+            n_common = 0
+
+        n_tokens = input_ids.shape[0]
+        if n_tokens > self._input_ids.shape[0]:
+            grown = np.zeros(max(n_tokens, 2 * self._input_ids.shape[0]), dtype=np.intc)
+            grown[:n_common] = self._input_ids[:n_common]
+            self._input_ids = grown
+        self._input_ids[n_common:n_tokens] = input_ids[n_common:n_tokens]
+        self._n_tokens = n_tokens
+
+        # An n-gram is only indexed once the token after it is known, so
+        # every hit has a continuation to draft from
+        base = max(self._n_indexed - self.max_ngram_size + 1, 0)
+        tokens = self._input_ids[base:n_tokens].tolist()
+        for end in range(self._n_indexed, n_tokens - 1):
+            for ngram_size in range(self.min_ngram_size, min(self.max_ngram_size, end + 1) + 1):
+                self._index[ngram_size][tuple(tokens[end - base - ngram_size + 1 : end - base + 1])] = end
+        self._n_indexed = max(self._n_indexed, n_tokens - 1)
+
+    def __call__(
+        self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any
+    ) -> npt.NDArray[np.intc]:
+        self._sync(input_ids)
+        n_tokens = self._n_tokens
+        for ngram_size in range(min(self.max_ngram_size, n_tokens - 1), self.min_ngram_size - 1, -1):
+            key = tuple(self._input_ids[n_tokens - ngram_size : n_tokens].tolist())
+            end = self._index[ngram_size].get(key)
+            if end is not None:
+                start_idx = end + 1
+                return self._input_ids[start_idx : min(start_idx + self.num_pred_tokens, n_tokens)].copy()
+        return np.array([], dtype=np.intc)
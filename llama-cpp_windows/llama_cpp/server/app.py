@@ -27,6 +27,7 @@ from sse_starlette.sse import EventSourceResponse
 from starlette_context.plugins import RequestIdPlugin  # type: ignore
 from starlette_context.middleware import RawContextMiddleware
 
+from llama_cpp.llama_batching import LlamaBatchScheduler
 from llama_cpp.server.model import (
     LlamaProxy,
 )
@@ -71,6 +72,11 @@ def set_llama_proxy(model_settings: List[ModelSettings]):
 
 
 def get_llama_proxy():
+    # NOTE: With continuous batching the requests share the decode steps of the
+    # scheduler, so they must not wait for each other here.
+    if _llama_proxy is not None and _llama_proxy.batching:
+        yield _llama_proxy
+        return
     # NOTE: This double lock allows the currently streaming llama model to
     # check if any other requests are pending in the same thread and cancel
     # the stream if so.
@@ -242,11 +248,16 @@ async def create_completion(
         assert len(body.prompt) <= 1
         body.prompt = body.prompt[0] if len(body.prompt) > 0 else ""
 
-    llama = llama_proxy(
+    model = (
         body.model
         if request.url.path != "/v1/engines/copilot-codex/completions"
         else "copilot-codex"
     )
+    llama: Union[llama_cpp.Llama, LlamaBatchScheduler] = (
+        llama_proxy.batch_scheduler(model)
+        if llama_proxy.batching
+        else llama_proxy(model)
+    )
 
     exclude = {
         "n",
@@ -302,6 +313,12 @@ async def create_embedding(
     request: CreateEmbeddingRequest,
     llama_proxy: LlamaProxy = Depends(get_llama_proxy),
 ):
+    if llama_proxy.batching:
+        # embed() clears the KV cache the batch scheduler is decoding in
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Embeddings are not available with continuous batching (n_slots > 1)",
+        )
     return await run_in_threadpool(
         llama_proxy(request.model).create_embedding,
         **request.model_dump(exclude={"user"}),
@@ -348,7 +365,11 @@ async def create_chat_completion(
         "user",
     }
     kwargs = body.model_dump(exclude=exclude)
-    llama = llama_proxy(body.model)
+    llama: Union[llama_cpp.Llama, LlamaBatchScheduler] = (
+        llama_proxy.batch_scheduler(body.model)
+        if llama_proxy.batching
+        else llama_proxy(body.model)
+    )
     if body.logit_bias is not None:
         kwargs["logit_bias"] = (
             _logit_bias_tokens_to_input_ids(llama, body.logit_bias)
@@ -2,12 +2,15 @@ from __future__ import annotations
 
 import json
 
+from threading import Lock
 from typing import Dict, Optional, Union, List
 
 import llama_cpp
 import llama_cpp.llama_speculative as llama_speculative
 import llama_cpp.llama_tokenizer as llama_tokenizer
 
+from llama_cpp.llama_batching import LlamaBatchScheduler
+
 from llama_cpp.server.settings import ModelSettings
 
 
@@ -24,6 +27,13 @@ class LlamaProxy:
         self._current_model: Optional[llama_cpp.Llama] = None
         self._current_model_alias: Optional[str] = None
 
+        # continuous batching is a property of the server, every model or none of them uses it
+        self.batching = models[0].n_slots > 1
+        if any((model.n_slots > 1) != self.batching for model in models):
+            raise ValueError("n_slots must be above 1 for every model or for none")
+        self._batch_scheduler: Optional[LlamaBatchScheduler] = None
+        self._batch_lock = Lock()
+
         self._default_model_settings: ModelSettings = models[0]
         self._default_model_alias: str = self._default_model_settings.model_alias  # type: ignore
 
@@ -51,6 +61,23 @@ class LlamaProxy:
         self._current_model_alias = model
         return self._current_model
 
+    def batch_scheduler(self, model: Optional[str] = None) -> LlamaBatchScheduler:
+        # the requests run concurrently, only switching the model is serialized
+        with self._batch_lock:
+            if model is None or model not in self._model_settings_dict:
+                model = self._default_model_alias
+            if model != self._current_model_alias and self._batch_scheduler is not None:
+                # the running requests of the previous model end here
+                self._batch_scheduler.close()
+                self._batch_scheduler = None
+            llama = self(model)
+            if self._batch_scheduler is None:
+                settings = self._model_settings_dict[model]
+                self._batch_scheduler = LlamaBatchScheduler(
+                    llama, n_slots=settings.n_slots, verbose=settings.verbose
+                )
+            return self._batch_scheduler
+
     def __getitem__(self, model: str):
         return self._model_settings_dict[model].model_dump()
 
@@ -64,6 +91,9 @@ class LlamaProxy:
             yield model
 
     def free(self):
+        if self._batch_scheduler is not None:
+            self._batch_scheduler.close()
+            self._batch_scheduler = None
         if self._current_model:
             del self._current_model
 
@@ -64,6 +64,11 @@ class ModelSettings(BaseSettings):
     n_batch: int = Field(
         default=512, ge=1, description="The batch size to use per eval."
     )
+    n_slots: int = Field(
+        default=1,
+        ge=1,
+        description="The number of completions decoded together by continuous batching, n_ctx is split evenly between them. Above 1 requests no longer wait for each other, but embeddings and the completion options that need the whole context (suffix, echo, logprobs, seed, grammar, logit_bias) are not available. Must be the same for all models.",
+    )
     n_threads: int = Field(
         default=max(multiprocessing.cpu_count() // 2, 1),
         ge=1,
@@ -1,7 +1,19 @@
 import requests
 import time
+import json
+import os
+import sys
 
 
+# with the local vector store there is no qdrant server to wait for
+if os.path.isfile('pq/settings/settings.dat'):
+    f = open('pq/settings/settings.dat','r')
+    settings = json.loads(f.read())
+    f.close()
+    if settings.get('vector_store', 'qdrant') == 'local':
+        print('local vector store selected, not waiting for qdrant')
+        sys.exit(0)
+
 
 trycount = 0
 while 1:
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import concurrent.futures
+
+import httpx
+
+from generators.automatics.client import automa_client
+
+
+class automa_async_client:
+    """Runs txt2img and interrogate jobs on one or more A1111/Forge backends without blocking the caller.
+
+    All requests share one asyncio loop in a background thread and one
+    keep-alive connection pool. Every job goes to the backend with the fewest
+    jobs in flight, the caller gets a concurrent.futures.Future back whose
+    result is the decoded json response, or '' if the request failed."""
+
+    def __init__(self, max_connections=8):
+        self.payloads = automa_client()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.session = asyncio.run_coroutine_threadsafe(self.create_session(max_connections), self.loop).result()
+
+    async def create_session(self, max_connections):
+        # image generation easily takes minutes, so no read timeout
+        return httpx.AsyncClient(timeout=httpx.Timeout(None, connect=10.0),
+                                 limits=httpx.Limits(max_connections=max_connections,
+                                                     max_keepalive_connections=max_connections))
+
+    def get_backends(self, settings_data):
+        urls = [url for url in settings_data['automa_urls'] if url != '']
+        if len(urls) == 0:
+            urls = [settings_data['automa_url']]
+        return urls
+
+    def pick_backend(self, urls):
+        with self.lock:
+            url = min(urls, key=lambda u: self.inflight.get(u, 0))
+            self.inflight[url] = self.inflight.get(url, 0) + 1
+        return url
+
+    def jobs_in_flight(self):
+        with self.lock:
+            return sum(self.inflight.values())
+
+    async def post(self, urls, api_endpoint, payload):
+        url = self.pick_backend(urls)
+        try:
+            response = await self.session.post(f'{url}/{api_endpoint}', json=payload)
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            print(e)
+            return ''
+        finally:
+            with self.lock:
+                self.inflight[url] -= 1
+
+    def submit(self, api_endpoint, payload, urls):
+        return asyncio.run_coroutine_threadsafe(self.post(urls, api_endpoint, payload), self.loop)
+
+    def request_generation(self, prompt, negative_prompt, settings_data):
+        payload = self.payloads.get_txt2img_payload(prompt, negative_prompt, settings_data)
+        return self.submit('sdapi/v1/txt2img', payload, self.get_backends(settings_data))
+
+    def request_interrogation(self, image, url):
+        return self.submit('sdapi/v1/interrogate', {"image": image, "model": "clip"}, [url])
+
+    def as_completed(self, futures):
+        return concurrent.futures.as_completed(futures)
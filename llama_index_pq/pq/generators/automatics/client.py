@@ -76,6 +76,12 @@ class automa_client:
         self.webui_server_url=settings_data["automa_url"]
         self.save = settings_data["automa_save"]
 
+        payload = self.get_txt2img_payload(prompt, negative_prompt, settings_data)
+
+        return self.call_txt2img_api(**payload)
+
+
+    def get_txt2img_payload(self, prompt, negative_prompt, settings_data):
 
         ADetailer = {}
         alwayson_scripts = {}
@@ -113,7 +119,7 @@ class automa_client:
             #"override_settings_restore_afterwards": true,
         }
 
-        return self.call_txt2img_api(**payload)
+        return payload
 
 
 
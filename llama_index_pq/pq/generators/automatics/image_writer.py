@@ -0,0 +1,85 @@
+import os
+import time
+import base64
+import itertools
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+
+class generated_image:
+    """One image of a generation response, the base64 string is decoded exactly once.
+
+    The raw png bytes are kept, PIL only decodes them when the gallery asks
+    for the thumbnail or the full image, and only the first time it asks."""
+
+    def __init__(self, base64_str, path=None):
+        self.data = base64.b64decode(base64_str)
+        self.path = path
+        self.written = None
+        self._thumbnail = None
+
+    def image(self):
+        return Image.open(BytesIO(self.data)).convert('RGB')
+
+    def thumbnail(self, size):
+        if self._thumbnail is None:
+            img = Image.open(BytesIO(self.data))
+            img.draft('RGB', (size, size))
+            img.thumbnail((size, size))
+            self._thumbnail = img.convert('RGB')
+        return self._thumbnail
+
+
+class image_names:
+    """File names for generated images, unique within the process.
+
+    The timestamp only changes once a second and several responses can be
+    decoded within the same second, so every response also gets the next
+    value of a counter."""
+
+    def __init__(self, directory, prefix):
+        self.directory = directory
+        self.prefix = prefix
+        self.counter = itertools.count()
+
+    def paths(self, count):
+        # the paths for the count images of one response
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(time.time()))
+        job = next(self.counter)
+        return [os.path.join(self.directory, f'{self.prefix}-{stamp}-{job:06d}-{index}.png') for index in range(count)]
+
+
+class image_writer:
+    """Writes the raw bytes of generated images on a thread pool.
+
+    At most max_pending writes are queued, submit blocks beyond that so a
+    large batch never keeps more than that many unwritten images in memory."""
+
+    def __init__(self, workers=2, max_pending=32):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image_writer')
+        self.slots = threading.BoundedSemaphore(max(int(max_pending), 1))
+
+    def write(self, data, path):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def submit(self, image):
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(self.write, image.data, image.path)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(self.done)
+        image.written = future
+        return future
+
+    def done(self, future):
+        self.slots.release()
+        if future.exception() is not None:
+            print(f'image writer: {future.exception()}')
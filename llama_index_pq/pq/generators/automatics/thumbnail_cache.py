@@ -0,0 +1,55 @@
+import os
+import json
+from collections import deque
+
+
+class thumbnail_cache:
+    """Gallery of a sail, kept as jpeg thumbnails on disk and indexed by step.
+
+    index.jsonl records step, prompt, the full png and the thumbnail of every
+    image. Only the paths and file sizes of the newest thumbnails stay in
+    memory, limited to max_items and max_bytes, and the gallery is handed
+    to gradio as file paths so the browser only fetches the new ones.
+    Thumbnails that fall out of the gallery are deleted, the full png
+    the index points to stays."""
+
+    def __init__(self, path, size=768, max_items=10, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.size = int(size)
+        self.max_items = max(int(max_items), 1)
+        self.max_bytes = int(max_bytes)
+        self.entries = deque()
+        self.total_bytes = 0
+        os.makedirs(path, exist_ok=True)
+        self.index_file = os.path.join(path, 'index.jsonl')
+
+    def add_step(self, step, prompt, images):
+        # a batch bigger than the gallery would push its first images straight out again, those get no thumbnail
+        skip = max(len(images) - self.max_items, 0)
+        records = []
+        for index, image in enumerate(images):
+            thumbnail_path = None
+            if index >= skip:
+                thumbnail_path = os.path.join(self.path, f'{step:06d}-{index:03d}.jpg')
+                image.thumbnail(self.size).save(thumbnail_path, 'JPEG', quality=85)
+                image_bytes = os.path.getsize(thumbnail_path)
+                self.entries.append((step, thumbnail_path, image_bytes))
+                self.total_bytes += image_bytes
+            records.append({'step': step, 'index': index, 'prompt': prompt,
+                            'image': image.path, 'thumbnail': thumbnail_path})
+        with open(self.index_file, 'a', encoding='utf8') as f:
+            for record in records:
+                f.write(f'{json.dumps(record)}\n')
+        self.trim()
+
+    def trim(self):
+        while len(self.entries) > 1 and (len(self.entries) > self.max_items or self.total_bytes > self.max_bytes):
+            step, thumbnail_path, image_bytes = self.entries.popleft()
+            self.total_bytes -= image_bytes
+            try:
+                os.remove(thumbnail_path)
+            except OSError as e:
+                print(f'thumbnail cache: {e}')
+
+    def gallery(self):
+        return [thumbnail_path for step, thumbnail_path, image_bytes in self.entries]
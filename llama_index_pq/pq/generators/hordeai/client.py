@@ -1,11 +1,9 @@
 
-from horde_sdk import ANON_API_KEY
-from horde_sdk.ai_horde_api import KNOWN_SAMPLERS
-from horde_sdk.ai_horde_api.ai_horde_clients import AIHordeAPISimpleClient
-from horde_sdk.ai_horde_api.apimodels import ImageGenerateAsyncRequest, ImageGenerationInputPayload, LorasPayloadEntry
 import json
 import os
 
+# horde_sdk takes a while to import and is only needed once a horde image is requested, so it is imported in place
+
 
 class hordeai_models:
     def read_model_list(self):
@@ -19,6 +17,7 @@ class hordeai_models:
 class hordeai_client:
 
     def __init__(self):
+        from horde_sdk.ai_horde_api import KNOWN_SAMPLERS
         self.samplers = {
             'k_lms': KNOWN_SAMPLERS.k_lms ,
             'k_heun': KNOWN_SAMPLERS.k_heun,
@@ -38,10 +37,13 @@ class hordeai_client:
 
 
     def get_annon_api_key(self):
+        from horde_sdk import ANON_API_KEY
         return ANON_API_KEY
 
     def get_generation_dict(self, api_key, prompt, negative_prompt, sampler, model, steps, cfg, width, heigth, clipskip):
 
+        from horde_sdk.ai_horde_api.apimodels import ImageGenerateAsyncRequest, ImageGenerationInputPayload
+
         sampler = self.samplers[sampler]
 
         prompt = f'{prompt}###{negative_prompt}'
@@ -73,6 +75,7 @@ class hordeai_client:
         )
 
     def request_generation(self, api_key, prompt, negative_prompt, sampler, model, steps, cfg, width, heigth, clipskip):
+        from horde_sdk.ai_horde_api.ai_horde_clients import AIHordeAPISimpleClient
         simple_client = AIHordeAPISimpleClient()
         status_response, job_id = simple_client.image_generate_request(self.get_generation_dict(api_key, prompt, negative_prompt, sampler, model, steps, cfg, width, heigth, clipskip))
 
@@ -0,0 +1,162 @@
+import os
+import re
+import json
+import hashlib
+import threading
+
+import numpy as np
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+
+class embedding_store:
+    """Vectors on disk, text hash -> row of a memory mapped float32 matrix.
+
+    keys.bin holds one sha1 digest per row in row order, it is only appended
+    after the vectors are flushed so a crash never leaves a key without its vector."""
+
+    key_size = 20
+
+    def __init__(self, path, grow_rows=65536):
+        self.path = path
+        self.grow_rows = grow_rows
+        self.vectors_file = os.path.join(path, 'vectors.f32')
+        self.keys_file = os.path.join(path, 'keys.bin')
+        self.meta_file = os.path.join(path, 'meta.json')
+        self.rows = {}
+        self.vectors = None
+        self.dim = None
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        if os.path.isfile(self.meta_file):
+            with open(self.meta_file, 'r') as f:
+                self.dim = json.load(f)['dim']
+            self.load()
+
+    def load(self):
+        row_bytes = self.dim * 4
+        stored_rows = os.path.getsize(self.vectors_file) // row_bytes if os.path.isfile(self.vectors_file) else 0
+        keys = b''
+        if os.path.isfile(self.keys_file):
+            with open(self.keys_file, 'rb') as f:
+                keys = f.read()
+        n = min(len(keys) // self.key_size, stored_rows)
+        for row in range(n):
+            self.rows[keys[row * self.key_size:(row + 1) * self.key_size]] = row
+        if len(keys) != n * self.key_size:
+            with open(self.keys_file, 'r+b') as f:
+                f.truncate(n * self.key_size)
+        self.open(max(stored_rows, self.grow_rows))
+
+    def open(self, capacity):
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        with open(self.vectors_file, 'ab') as f:
+            if f.tell() < capacity * self.dim * 4:
+                f.truncate(capacity * self.dim * 4)
+        self.vectors = np.memmap(self.vectors_file, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+
+    def key(self, text):
+        return hashlib.sha1(text.encode('utf8')).digest()
+
+    def get(self, keys):
+        with self.lock:
+            return [self.vectors[self.rows[key]].tolist() if key in self.rows else None for key in keys]
+
+    def put(self, keys, vectors):
+        with self.lock:
+            if self.dim is None:
+                self.dim = len(vectors[0])
+                with open(self.meta_file, 'w') as f:
+                    json.dump({'dim': self.dim}, f)
+                self.load()
+
+            new_keys = []
+            for key, vector in zip(keys, vectors):
+                if key in self.rows:
+                    continue
+                row = len(self.rows)
+                if row >= self.vectors.shape[0]:
+                    self.open(self.vectors.shape[0] + self.grow_rows)
+                self.vectors[row] = vector
+                self.rows[key] = row
+                new_keys.append(key)
+
+            if len(new_keys) > 0:
+                self.vectors.flush()
+                with open(self.keys_file, 'ab') as f:
+                    f.write(b''.join(new_keys))
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class embedding_service(BaseEmbedding):
+    """One embedding model for the whole process, every vector it computes is kept in an embedding_store."""
+
+    _embed_model = PrivateAttr()
+    _store = PrivateAttr()
+    _prefix = PrivateAttr()
+    _hits = PrivateAttr(default=0)
+    _misses = PrivateAttr(default=0)
+
+    def __init__(self, embed_model, store, **kwargs):
+        super().__init__(model_name=embed_model.model_name, embed_batch_size=embed_model.embed_batch_size, **kwargs)
+        self._embed_model = embed_model
+        self._store = store
+        self._prefix = f'{embed_model.model_name}\0'
+
+    @classmethod
+    def class_name(cls):
+        return 'embedding_service'
+
+    def lookup(self, kind, texts, embed_function):
+        # query and text embeddings may differ by instruction, so they are stored apart
+        keys = [self._store.key(f'{self._prefix}{kind}\0{text}') for text in texts]
+        vectors = self._store.get(keys)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        self._hits += len(texts) - len(missing)
+        self._misses += len(missing)
+        if len(missing) > 0:
+            computed = embed_function([texts[i] for i in missing])
+            self._store.put([keys[i] for i in missing], computed)
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+        return vectors
+
+    def _get_query_embedding(self, query):
+        return self.lookup('query', [query], lambda texts: [self._embed_model._get_query_embedding(texts[0])])[0]
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        return self.lookup('text', texts, self._embed_model._get_text_embeddings)
+
+    @property
+    def stats(self):
+        requests = self._hits + self._misses
+        return {'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / requests if requests > 0 else 0.0,
+                'stored': len(self._store)}
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_embedding_service(model_name="sentence-transformers/all-MiniLM-L12-v2", cache_dir='embedding_cache'):
+    global _service
+    with _service_lock:
+        if _service is None:
+            store = embedding_store(os.path.join(cache_dir, re.sub(r'[^\w.-]', '_', model_name)))
+            _service = embedding_service(HuggingFaceEmbedding(model_name=model_name), store)
+    return _service
@@ -1,15 +1,29 @@
 import globals
-import gc
 import os
+import re
+import time
+import queue
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 
 from llama_index.core.prompts import PromptTemplate
 from llama_index.llms.llama_cpp import LlamaCPP
 from llama_index.llms.llama_cpp.llama_utils import messages_to_prompt, completion_to_prompt
-from llama_index.core import VectorStoreIndex
+from llama_index.core import VectorStoreIndex, QueryBundle
+from llama_index.core.schema import NodeWithScore, TextNode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
 from llama_index.vector_stores.qdrant import QdrantVectorStore
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 import qdrant_client
+from qdrant_client.http import models as qdrant_models
+from llama_cpp import Llama, LlamaDiskCache, LlamaState
+
+from llm_fw.model_registry import model_registry
+from llm_fw.embedding_service import get_embedding_service
+from llm_fw.local_vector_store import local_qdrant_client
+from startup_profile import profile
 
 
 
@@ -24,10 +38,26 @@ class adapter:
     def __init__(self):
         self.index='prompts_large_meta'
         self.g = globals.get_globals()
+        self.models = model_registry(max_models=self.g.settings_data['resident_models'],
+                                     max_bytes=self.g.settings_data['resident_models_ram_gb'] * (1 << 30))
         self.document_store = self.set_document_store()
-        self.llm = self.set_llm()
-        self.set_pipeline()
+        # the embedder and the LLM do not need each other, they load side by side
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix='model_loader') as pool:
+            vector_index = pool.submit(self.profiled, 'embedder', self.set_vector_index)
+            llm = pool.submit(self.profiled, 'llm', self.set_llm)
+            vector_index.result()
+            self.llm = llm.result()
+        with profile.stage('query engine'):
+            self.set_pipeline()
+        with profile.stage('prompt prefix warmup'):
+            self.warmup_prompt_prefix()
         self.last_context = []
+        self.query_stats = {}
+        self.retrieval_cache = None
+
+    def profiled(self, name, function):
+        with profile.stage(name):
+            return function()
 
     def get_instruct(self):
         return self.g.settings_data['Instruct Model']
@@ -35,6 +65,10 @@ class adapter:
         return self.document_store
 
     def set_document_store(self):
+        if self.g.settings_data['vector_store'] == 'local':
+            # exported collections searched in process, see scripts/export_qdrant_local.py
+            return local_qdrant_client(self.g.settings_data['local_index_path'],
+                                       nprobe=self.g.settings_data['local_index_nprobe'])
         return qdrant_client.QdrantClient(
             # you can use :memory: mode for fast and light-weight experiments,
             # it does not require to have Qdrant deployed anywhere
@@ -48,9 +82,51 @@ class adapter:
 
     def get_llm(self):
         return self.llm
-    def set_llm(self):
 
-        return LlamaCPP(
+    def get_state_cache(self):
+        # saved states only fit the model, context length and logits layout they were taken with,
+        # prompt lookup turns on logits_all
+        model_name = re.sub(r'[^\w.-]', '_', self.g.settings_data['LLM Model'])
+        cache_name = f'{model_name}_{self.g.settings_data["Context Length"]}'
+        if self.llm._model.context_params.logits_all:
+            cache_name += '_logits_all'
+        cache_dir = os.path.join('llm_cache', cache_name)
+        return LlamaDiskCache(cache_dir=cache_dir,
+                              capacity_bytes=int(self.g.settings_data['llm_state_cache_size_gb'] * (1 << 30)))
+
+    def set_llm(self):
+        # only the settings that change how the weights and the context are loaded need a new model
+        key = (self.g.settings_data['model_list'][self.g.settings_data['LLM Model']]['path'],
+               self.g.settings_data["Context Length"],
+               self.g.settings_data["GPU Layers"],
+               self.g.settings_data['llm_prompt_lookup'])
+        llm = self.models.get(key, self.load_llm)
+        if self.g.settings_data['llm_prompt_lookup']:
+            # the lookup parameters can change without reloading the weights
+            llm._model.draft_model = self.get_draft_model()
+
+        llm.temperature = self.g.settings_data["Temperature"]
+        llm.max_new_tokens = self.g.settings_data["max output Tokens"]
+        llm.generate_kwargs.update({"temperature": llm.temperature, "max_tokens": llm.max_new_tokens})
+        return llm
+
+    def get_draft_model(self):
+        # the prompts copy whole phrases from the retrieved context, those get drafted from the prompt itself
+        try:
+            # only the llama_cpp folder of llama-cpp_windows has the incremental index
+            from llama_cpp.llama_speculative import LlamaPromptLookupIndex as prompt_lookup
+        except ImportError:
+            from llama_cpp.llama_speculative import LlamaPromptLookupDecoding as prompt_lookup
+        return prompt_lookup(max_ngram_size=self.g.settings_data['llm_prompt_lookup_max_ngram'],
+                             num_pred_tokens=self.g.settings_data['llm_prompt_lookup_num_pred_tokens'])
+
+    def load_llm(self):
+
+        model_kwargs = {"n_gpu_layers": self.g.settings_data["GPU Layers"]}
+        if self.g.settings_data['llm_prompt_lookup']:
+            model_kwargs['draft_model'] = self.get_draft_model()
+
+        llm = LlamaCPP(
 
             model_url=self.g.settings_data['model_list'][self.g.settings_data['LLM Model']]['path'],
 
@@ -68,7 +144,7 @@ class adapter:
 
             # kwargs to pass to __init__()
             # set to at least 1 to use GPU, check with your model the number need to fully run on GPU might be way higher than 1
-            model_kwargs={"n_gpu_layers": self.g.settings_data["GPU Layers"]}, # I need to play with this and see if it actually helps
+            model_kwargs=model_kwargs, # I need to play with this and see if it actually helps
 
             # transform inputs into Llama2 format
             messages_to_prompt=messages_to_prompt,
@@ -76,21 +152,23 @@ class adapter:
             verbose=True,
         )
 
+        return llm
+
     def get_retriever(self, similarity_top_k):
         return self.vector_index.as_retriever(similarity_top_k=similarity_top_k)
 
-    def set_pipeline(self):
-
-        if hasattr(self,'query_engine'):
-            del self.vector_store
-            del self.vector_index
-            del self.query_engine
-
-
-        self.embed_model = HuggingFaceEmbedding(model_name="sentence-transformers/all-MiniLM-L12-v2")
+    def set_vector_index(self):
+        # the embedder and the vector index do not depend on the LLM, they live as long as the adapter
+        if self.g.settings_data['embedding_cache']:
+            # shared by every retrieval path and kept on disk across restarts
+            self.embed_model = get_embedding_service(model_name="sentence-transformers/all-MiniLM-L12-v2")
+        else:
+            self.embed_model = HuggingFaceEmbedding(model_name="sentence-transformers/all-MiniLM-L12-v2")
         self.vector_store = QdrantVectorStore(client=self.document_store, collection_name=self.index)
         self.vector_index = VectorStoreIndex.from_vector_store( vector_store=self.vector_store, embed_model=self.embed_model)
 
+    def set_pipeline(self):
+
         self.retriever = self.get_retriever(similarity_top_k=self.g.settings_data['top_k'])
 
         self.query_engine = self.vector_index.as_query_engine(similarity_top_k=self.g.settings_data['top_k'],llm=self.llm)
@@ -101,12 +179,109 @@ class adapter:
             {"response_synthesizer:text_qa_template": self.qa_prompt_tmpl}
         )
 
+    def get_template_prefix(self):
+        # everything in front of the first template variable is the same for every query,
+        # LlamaCPP wraps the whole prompt with completion_to_prompt before the model sees it
+        template = self.g.settings_data['prompt_templates']['prompt_template_b']
+        prefix = re.split(r'{\w+}', template, maxsplit=1)[0]
+        marker = '<<prompt_quill_prefix_end>>'
+        return self.llm.completion_to_prompt(prefix + marker).split(marker)[0]
+
+    def vendored_llama_cpp(self):
+        # only the llama_cpp folder of llama-cpp_windows loads a state that keeps a single row of scores,
+        # the pip wheel needs all n_ctx rows and its disk cache drops an entry once it is read
+        try:
+            from llama_cpp.llama_speculative import LlamaPromptLookupIndex
+        except ImportError:
+            return False
+        return True
+
+    def trim_state(self, state):
+        # after a load_state only the scores of the last token are read
+        row = max(min(state.n_tokens, state.scores.shape[0]) - 1, 0)
+        return LlamaState(input_ids=state.input_ids.copy(),
+                          scores=state.scores[row:row + 1, :].copy(),
+                          n_tokens=state.n_tokens,
+                          llama_state=state.llama_state,
+                          llama_state_size=state.llama_state_size)
+
+    def warmup_prompt_prefix(self):
+        model = self.llm._model
+        self.prefix_state = None
+        # tokenized like create_completion does it, the last token may merge with the text
+        # that follows, so it stays out of the snapshot
+        self.prefix_tokens = model.tokenize(self.get_template_prefix().encode('utf-8'), special=True)[:-1]
+        self.prefix_token_time = 0.0
+        if len(self.prefix_tokens) < 2:
+            return
+
+        start = time.time()
+        model.reset()
+        # with the pip wheel a snapshot would hold n_ctx x n_vocab scores, about 0.5 GB,
+        # the prefix is then only evaluated for the first query
+        keep_state = self.vendored_llama_cpp()
+        # only the prefix states go to disk, as the model's cache every completion would be saved
+        cache = self.get_state_cache() if keep_state and self.g.settings_data['llm_state_cache'] else None
+        cached = None
+        if cache is not None and self.prefix_tokens in cache:
+            cached = cache[self.prefix_tokens]
+            if cached.input_ids[:len(self.prefix_tokens)].tolist() != self.prefix_tokens:
+                cached = None
+        if cached is not None:
+            model.load_state(cached)
+            model.n_tokens = len(self.prefix_tokens)
+            model._ctx.kv_cache_seq_rm(-1, model.n_tokens, -1)
+        else:
+            model.eval(self.prefix_tokens)
+            self.prefix_token_time = (time.time() - start) / len(self.prefix_tokens)
+        if keep_state:
+            self.prefix_state = self.trim_state(model.save_state())
+            if cached is None and cache is not None:
+                cache[self.prefix_tokens] = self.prefix_state
+        print(f'prompt prefix warmup: {len(self.prefix_tokens)} tokens in {time.time() - start:.2f}s')
+        # the stock LlamaDiskCache of the pip wheel keeps no stats
+        if getattr(cache, 'stats', None) is not None:
+            print(f'llm state cache: {cache.stats}')
+
+    def restore_prompt_prefix(self):
+        # the live context already holds the prefix after most queries, then it is simply reused
+        if self.prefix_state is None:
+            return
+        model = self.llm._model
+        if Llama.longest_token_prefix(model._input_ids, self.prefix_tokens) < len(self.prefix_tokens):
+            model.load_state(self.prefix_state)
+
+    def log_query_stats(self, mode, saved_tokens, seconds):
+        stats = self.query_stats.setdefault(mode, {'requests': 0, 'seconds': 0.0, 'saved_tokens': 0})
+        stats['requests'] += 1
+        stats['seconds'] += seconds
+        stats['saved_tokens'] += saved_tokens
+        saved_time = ''
+        if self.prefix_token_time > 0:
+            saved_time = f' (~{saved_tokens * self.prefix_token_time:.2f}s saved)'
+        print(f'{mode} request: {seconds:.2f}s, {saved_tokens} prefill tokens reused from the live context{saved_time}, '
+              f'average {stats["seconds"] / stats["requests"]:.2f}s over {stats["requests"]} requests')
+
+        model = self.llm._model
+        generated = getattr(model, 'n_generated', 0)
+        if generated == 0:
+            return
+        stats['tokens'] = stats.get('tokens', 0) + generated
+        line = f'{mode} request: {generated} tokens, {generated / max(seconds, 1e-6):.1f} tokens/s'
+        if model.draft_model is not None:
+            stats['draft_proposed'] = stats.get('draft_proposed', 0) + model.n_draft_proposed
+            stats['draft_accepted'] = stats.get('draft_accepted', 0) + model.n_draft_accepted
+            line += (f', prompt lookup accepted {model.n_draft_accepted} of {model.n_draft_proposed} drafted tokens '
+                     f'({model.n_draft_accepted / max(model.n_draft_proposed, 1):.0%}, '
+                     f'{stats["draft_accepted"] / max(stats["draft_proposed"], 1):.0%} over all {mode} requests)')
+        print(line)
+
     def retrieve_context(self, prompt):
         return self.retriever.retrieve(prompt)
 
 
     def get_context_text(self, query):
-        nodes = self.retrieve_context(query)
+        nodes = self.search_batch([query], self.g.settings_data['top_k'])[0]
         return [s.node.get_text() for s in nodes]
 
 
@@ -116,20 +291,148 @@ class adapter:
         negative_prompts = []
         for key in response.metadata.keys():
             if 'negative_prompt' in response.metadata[key]:
-                negative_prompts = negative_prompts + response.metadata[key]['negative_prompt'].split(',')
-                self.g.models_list.append(f'{response.metadata[key]["model_name"]}')
+                # deduplicated prompts carry a list with the meta data of every copy
+                negative_prompt = response.metadata[key]['negative_prompt']
+                model_name = response.metadata[key]['model_name']
+                if isinstance(negative_prompt, list):
+                    negative_prompt = ','.join(negative_prompt)
+                if not isinstance(model_name, list):
+                    model_name = [model_name]
+                negative_prompts = negative_prompts + negative_prompt.split(',')
+                self.g.models_list += [f'{name}' for name in model_name]
 
             if len(negative_prompts) > 0:
                 self.g.negative_prompt_list = set(negative_prompts)
 
 
 
-    def retrieve_query(self, query):
-        response =  self.query_engine.query(query)
+    def points_to_nodes(self, points):
+        nodes = []
+        for point in points:
+            try:
+                node = metadata_dict_to_node(point.payload)
+            except Exception:
+                node = TextNode(id_=str(point.id), text=point.payload.get('text', ''))
+            nodes.append(NodeWithScore(node=node, score=point.score))
+        return nodes
+
+    def get_points_count(self, collection):
+        return self.document_store.get_collection(collection_name=collection).points_count
+
+    def get_search_params(self):
+        # only used by quantized collections, the candidates get rescored with the full vectors
+        return qdrant_models.SearchParams(quantization=qdrant_models.QuantizationSearchParams(
+            rescore=self.g.settings_data['quantization_rescore'],
+            oversampling=self.g.settings_data['quantization_oversampling']))
+
+    def search_batch(self, queries, similarity_top_k):
+        # one embedding pass and one Qdrant round-trip for the whole list of queries
+        if not isinstance(similarity_top_k, list):
+            similarity_top_k = [similarity_top_k] * len(queries)
+        cache = self.retrieval_cache
+        results = [None] * len(queries)
+        embeddings = {}
+        if cache is not None:
+            cache.check_collection(self.index)
+            for i, (query, top_k) in enumerate(zip(queries, similarity_top_k)):
+                results[i] = cache.get(query, top_k, self.index)
+                embedding = cache.get_embedding(query)
+                if embedding is not None:
+                    embeddings[query] = embedding
+
+        missing = [i for i, nodes in enumerate(results) if nodes is None]
+        if len(missing) == 0:
+            return results
+
+        unique_queries = [query for query in dict.fromkeys(queries[i] for i in missing) if query not in embeddings]
+        if len(unique_queries) > 0:
+            embeddings.update(zip(unique_queries, self.embed_model.get_text_embedding_batch(unique_queries)))
+        params = self.get_search_params()
+        requests = [qdrant_models.SearchRequest(vector=embeddings[queries[i]], limit=int(similarity_top_k[i]),
+                                                with_payload=True, params=params)
+                    for i in missing]
+        for i, points in zip(missing, self.document_store.search_batch(collection_name=self.index, requests=requests)):
+            results[i] = self.points_to_nodes(points)
+            if cache is not None:
+                cache.put(queries[i], similarity_top_k[i], self.index, embeddings[queries[i]], results[i])
+        return results
+
+    def retrieve_query_batch(self, queries, mode='batch', chunk_size=64):
+        # retrieval for the next chunk runs in a background thread while the LLM works through the queue
+        work = queue.Queue(maxsize=chunk_size * 2)
+        stop = threading.Event()
+        queries = iter(queries)
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    work.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    pass
+
+        def produce():
+            try:
+                while not stop.is_set():
+                    chunk = list(itertools.islice(queries, chunk_size))
+                    if len(chunk) == 0:
+                        break
+                    for query, nodes in zip(chunk, self.search_batch(chunk, self.g.settings_data['top_k'])):
+                        put((query, nodes))
+            except Exception as e:
+                put(e)
+            put(None)
+
+        threading.Thread(target=produce, daemon=True).start()
+        start = time.time()
+        n = 0
+        try:
+            while True:
+                item = work.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                query, nodes = item
+                yield self.synthesize_query(query, nodes, mode)
+                n += 1
+        finally:
+            stop.set()
+            if n > 0:
+                print(f'{mode}: {n} prompts at {n / ((time.time() - start) / 60):.1f} prompts/minute')
+
+    def retrieve_query_with_targets(self, query, target_query, sail_depth):
+        # a sail step needs the context for the LLM and the candidates for the next target, both come from one search
+        nodes, targets = self.search_batch([query, target_query], [self.g.settings_data['top_k'], sail_depth])
+        return self.synthesize_query(query, nodes, 'sail'), targets
+
+    def synthesize_query(self, query, nodes, mode='batch'):
+        return self.run_query(mode, lambda: self.query_engine.synthesize(QueryBundle(query), nodes))
+
+    def retrieve_query(self, query, mode='chat'):
+        return self.run_query(mode, lambda: self.query_engine.query(query))
+
+    def run_query(self, mode, query_function):
+        start = time.time()
+        self.restore_prompt_prefix()
+        model = self.llm._model
+        live_tokens = model._input_ids.tolist()
+        response = query_function()
+        # generate kept the tokens the new context shares with the one it started from
+        saved_tokens = Llama.longest_token_prefix(live_tokens, model._input_ids)
+        self.log_query_stats(mode, saved_tokens, time.time() - start)
         self.g.last_context = [s.node.get_text() for s in response.source_nodes]
         return response.response.lstrip(" ")
 
 
+    def log(self,logfile, text):
+        f = open(logfile, 'a')
+        try:
+            f.write(f"QUERY: {text} \n")
+        except:
+            pass
+        f.close()
+
     def change_model(self,model,temperature,n_ctx,n_gpu_layers,max_tokens,top_k, instruct):
 
         self.g.settings_data["Context Length"] = n_ctx
@@ -140,15 +443,10 @@ class adapter:
         self.g.settings_data['Instruct Model'] = instruct
         self.g.settings_data['LLM Model'] = model["name"]
 
-        self.llm._model = None
-        del self.llm
-
         self.llm = self.set_llm()
 
-        # delete the model from Ram
-        gc.collect()
-
         self.set_pipeline()
+        self.warmup_prompt_prefix()
         return f'Model set to {model["name"]}'
 
     def set_prompt(self,prompt_text):
@@ -157,13 +455,7 @@ class adapter:
 
         self.log('magic_prompt_logfile.txt',f"Magic Prompt: \n{prompt_text} \n")
 
-        self.llm._model = None
-        del self.llm
-
-        # delete the model from Ram
-        gc.collect()
-
-        self.llm = self.set_llm()
-
+        # a new template only needs a new query engine, the model weights stay loaded
         self.set_pipeline()
+        self.warmup_prompt_prefix()
         return f'Magic Prompt set to:\n {prompt_text}'
\ No newline at end of file
@@ -13,11 +13,13 @@
 # permissions and limitations under the License.
 
 import globals
-from llm_fw.llama_index_interface import adapter
+from llm_fw.retrieval_cache import retrieval_cache
+from startup_profile import profile
 
 from settings.io import settings_io
-from deep_translator import GoogleTranslator
 import os
+import threading
+import numpy as np
 
 out_dir = 'api_out'
 out_dir_t2t = os.path.join(out_dir, 'txt2txt')
@@ -27,9 +29,51 @@ class LLM_INTERFACE:
     def __init__(self):
 
         self.g = globals.get_globals()
-        self.adapter = adapter()
+        self._adapter = None
+        self.load_error = None
+        self.ready = threading.Event()
+        # Deep Dive and Sailing ask for the same texts again and again
+        self.retrieval_cache = retrieval_cache(max_entries=self.g.settings_data['retrieval_cache_size'],
+                                               ttl=self.g.settings_data['retrieval_cache_ttl'],
+                                               check_seconds=self.g.settings_data['retrieval_cache_check_seconds'],
+                                               points_count=self.get_points_count)
         self.g.negative_prompt_list = []
         self.g.models_list = []
+        # the ui serves while llama_index, the embedder and the LLM load, whatever needs them waits in self.adapter
+        threading.Thread(target=self.load_adapter, name='adapter_loader', daemon=True).start()
+
+    def load_adapter(self):
+        try:
+            with profile.stage('adapter'):
+                with profile.stage('llama_index import'):
+                    from llm_fw.llama_index_interface import adapter
+                self._adapter = adapter()
+            if self.g.settings_data['retrieval_cache']:
+                self._adapter.retrieval_cache = self.retrieval_cache
+        except Exception as e:
+            self.load_error = e
+            print(f'loading the models failed: {e}')
+        finally:
+            self.ready.set()
+            profile.mark('models ready')
+            profile.report()
+
+    @property
+    def adapter(self):
+        self.ready.wait()
+        if self._adapter is None:
+            raise RuntimeError(f'loading the models failed: {self.load_error}')
+        return self._adapter
+
+    def get_status(self):
+        if not self.ready.is_set():
+            return f'Loading the LLM and the embedder ... {profile.now():.0f}s'
+        if self._adapter is None:
+            return f'Loading the models failed: {self.load_error}'
+        return 'Ready'
+
+    def get_points_count(self, collection):
+        return self.adapter.get_points_count(collection)
 
 
 
@@ -56,8 +100,12 @@ class LLM_INTERFACE:
 
     def retrieve_context(self, query):
         self.last_context = self.adapter.get_context_text(query)
+        print(f'retrieval cache: {self.get_retrieval_cache_stats()}')
         return self.last_context
 
+    def get_retrieval_cache_stats(self):
+        return self.retrieval_cache.stats
+
 
     def set_top_k(self, top_k):
         self.g.settings_data['top_k'] = top_k
@@ -73,6 +121,7 @@ class LLM_INTERFACE:
 
 
     def translate(self, query):
+        from deep_translator import GoogleTranslator
         tanslated = GoogleTranslator(source='auto', target='en').translate(query)
         return tanslated
 
@@ -80,18 +129,15 @@ class LLM_INTERFACE:
     def run_batch_response(self,context):
         output = ''
         n = 1
-        for query in context:
-            if query != '':
-                response = self.adapter.retrieve_query(query)
-                output = f'{output}\n\n\nPrompt {str(n)}:\n{response}'
-                self.log(os.path.join(out_dir_t2t,'WildcardReady.txt'),f'{response}\n')
-                n += 1
+        for response in self.adapter.retrieve_query_batch([query for query in context if query != ''], mode='batch'):
+            output = f'{output}\n\n\nPrompt {str(n)}:\n{response}'
+            self.log(os.path.join(out_dir_t2t,'WildcardReady.txt'),f'{response}\n')
+            n += 1
 
         return output
 
 
-
-    def run_llm_response_batch(self, query):
+    def prepare_batch_query(self, query):
 
         if self.g.settings_data['translate']:
             query = self.translate(query)
@@ -99,7 +145,12 @@ class LLM_INTERFACE:
         if self.g.settings_data['Instruct Model'] is True:
             query = f'[INST]{query}[/INST]'
 
-        response = self.adapter.retrieve_query(query)
+        return query
+
+
+    def run_llm_response_batch(self, query):
+
+        response = self.adapter.retrieve_query(self.prepare_batch_query(query), mode='file2file')
 
         output = response
         output = output.replace('\n','')
@@ -107,6 +158,13 @@ class LLM_INTERFACE:
         return output
 
 
+    def run_llm_response_batch_list(self, queries):
+        # the queries are prepared lazily, so translation also runs ahead of the LLM
+        prepared = (self.prepare_batch_query(query) for query in queries)
+        for response in self.adapter.retrieve_query_batch(prepared, mode='file2file'):
+            yield response.replace('\n','')
+
+
     def get_retriever(self,similarity_top_k):
         return  self.adapter.get_retriever(similarity_top_k=similarity_top_k)
 
@@ -117,15 +175,24 @@ class LLM_INTERFACE:
 
 
     def get_query_texts(self, nodes):
-        target_dict = {}
+        # candidates for the next sail target, every text once and nothing the sail already visited
+        candidates = {}
         for node in nodes:
-            if node.text not in self.g.sail_history:
-                target_dict[node.score] = node.text
-        return target_dict
+            if node.text not in self.g.sail_history and node.text not in candidates:
+                candidates[node.text] = node.score
+        texts = list(candidates.keys())
+        scores = np.fromiter(candidates.values(), dtype=np.float32, count=len(texts))
+        embeddings = None
+        if self.g.settings_data['sail_novelty'] > 0 and len(texts) > 0:
+            embeddings = np.asarray(self.adapter.embed_model.get_text_embedding_batch(texts), dtype=np.float32)
+        return texts, scores, embeddings
 
 
     def retrieve_query(self, query):
-        return self.adapter.retrieve_query(query)
+        return self.adapter.retrieve_query(query, mode='sail')
+
+    def retrieve_query_with_targets(self, query, target_query, sail_depth):
+        return self.adapter.retrieve_query_with_targets(query, target_query, sail_depth)
 
     def run_llm_response(self, query, history):
 
@@ -138,6 +205,7 @@ class LLM_INTERFACE:
             query = f'[INST]{query}[/INST]'
 
         response = self.adapter.retrieve_query(query)
+        profile.mark('first answer')
 
         self.log('logfile.txt',f"RESPONSE: {response} \n-------------\n")
         self.log(os.path.join(out_dir_t2t,'WildcardReady.txt'),f'{response}\n')
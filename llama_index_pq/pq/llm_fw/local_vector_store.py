@@ -0,0 +1,359 @@
+import os
+import json
+import shutil
+from types import SimpleNamespace
+
+import numpy as np
+
+from qdrant_client.http import models as qdrant_models
+
+
+# an exported collection is a folder:
+#   meta.json          dim, count, nlist
+#   vectors.f32        normalized float32 vectors, sorted by IVF cluster
+#   centroids.npy      IVF cluster centers
+#   offsets.npy        first row of every cluster in vectors.f32, plus the end
+#   rows.npy           original row of every vector, that is the row in the payload columns
+#   columns/<n>.bin    json encoded payload values of one key, one after the other
+#   columns/<n>.idx    int64 start offset of every row in <n>.bin, empty means not set
+
+
+class payload_columns:
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'columns.json'), 'r') as f:
+            self.keys = json.load(f)
+        self.data = []
+        self.offsets = []
+        for n in range(len(self.keys)):
+            bin_file = os.path.join(path, f'{n}.bin')
+            self.data.append(np.memmap(bin_file, dtype=np.uint8, mode='r') if os.path.getsize(bin_file) > 0 else np.zeros(0, np.uint8))
+            self.offsets.append(np.load(os.path.join(path, f'{n}.idx.npy'), mmap_mode='r'))
+
+    def get(self, row, keys=None):
+        payload = {}
+        for n, name in enumerate(self.keys):
+            if keys is not None and name not in keys:
+                continue
+            start, end = self.offsets[n][row], self.offsets[n][row + 1]
+            if end > start:
+                payload[name] = json.loads(self.data[n][start:end].tobytes())
+        return payload
+
+
+class payload_columns_writer:
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.keys = []
+        self.files = []
+        self.offsets = []
+        self.rows = 0
+
+    def add_column(self, key):
+        self.files.append(open(os.path.join(self.path, f'{len(self.keys)}.bin'), 'wb'))
+        # rows written before the key showed up simply have no value
+        self.offsets.append([0] * (self.rows + 1))
+        self.keys.append(key)
+
+    def add(self, payload):
+        for key in payload:
+            if key not in self.keys:
+                self.add_column(key)
+        for n, key in enumerate(self.keys):
+            if key in payload:
+                data = json.dumps(payload[key]).encode('utf8')
+                self.files[n].write(data)
+                self.offsets[n].append(self.offsets[n][-1] + len(data))
+            else:
+                self.offsets[n].append(self.offsets[n][-1])
+        self.rows += 1
+
+    def close(self):
+        for n, f in enumerate(self.files):
+            f.close()
+            np.save(os.path.join(self.path, f'{n}.idx.npy'), np.array(self.offsets[n], dtype=np.int64))
+        with open(os.path.join(self.path, 'columns.json'), 'w') as f:
+            json.dump(self.keys, f)
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class local_index_writer:
+    """Collects points and builds a local_vector_index from them.
+
+    Vectors and payloads are streamed to disk as they come, finish() trains
+    the IVF clusters on a sample and writes the vectors sorted by cluster."""
+
+    def __init__(self, path, dim):
+        self.path = path
+        self.dim = dim
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        self.raw_file = os.path.join(path, 'vectors.raw')
+        self.raw = open(self.raw_file, 'wb')
+        self.columns = payload_columns_writer(os.path.join(path, 'columns'))
+        self.count = 0
+
+    def add(self, point_id, vector, payload):
+        self.raw.write(normalize(np.asarray(vector, dtype=np.float32)).tobytes())
+        payload = dict(payload or {})
+        payload['__id__'] = point_id
+        self.columns.add(payload)
+        self.count += 1
+
+    def kmeans(self, sample, nlist, iterations):
+        rng = np.random.default_rng(0)
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assign = self.assign(sample, centroids)
+            order = np.argsort(assign, kind='stable')
+            counts = np.bincount(assign, minlength=nlist)
+            sums = np.zeros_like(centroids)
+            filled = counts > 0
+            sums[filled] = np.add.reduceat(sample[order], np.cumsum(counts)[filled] - counts[filled])
+            empty = ~filled
+            # empty clusters get a new random seed instead of staying dead
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            centroids = normalize(sums)
+        return centroids
+
+    def assign(self, vectors, centroids, chunk=65536):
+        out = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), chunk):
+            out[start:start + chunk] = np.argmax(vectors[start:start + chunk] @ centroids.T, axis=1)
+        return out
+
+    def finish(self, nlist=None, sample_size=200000, iterations=10):
+        self.raw.close()
+        self.columns.close()
+        raw = np.memmap(self.raw_file, dtype=np.float32, mode='r', shape=(self.count, self.dim))
+
+        if nlist is None:
+            nlist = int(4 * np.sqrt(self.count))
+        nlist = max(1, min(nlist, self.count))
+        rng = np.random.default_rng(0)
+        sample = np.asarray(raw[np.sort(rng.choice(self.count, min(sample_size, self.count), replace=False))])
+        centroids = self.kmeans(sample, nlist, iterations)
+
+        assign = self.assign(raw, centroids)
+        rows = np.argsort(assign, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+
+        vectors = np.memmap(os.path.join(self.path, 'vectors.f32'), dtype=np.float32, mode='w+', shape=(self.count, self.dim))
+        for start in range(0, self.count, 65536):
+            vectors[start:start + 65536] = raw[rows[start:start + 65536]]
+        vectors.flush()
+        del vectors
+        del raw
+        os.remove(self.raw_file)
+
+        np.save(os.path.join(self.path, 'centroids.npy'), centroids.astype(np.float32))
+        np.save(os.path.join(self.path, 'offsets.npy'), offsets)
+        np.save(os.path.join(self.path, 'rows.npy'), rows.astype(np.int64))
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'dim': self.dim, 'count': self.count, 'nlist': nlist}, f)
+
+
+class local_vector_index:
+    """IVF index over a memory mapped vector matrix, loading only maps the files."""
+
+    def __init__(self, path, nprobe=16):
+        self.path = path
+        self.nprobe = nprobe
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.count = self.meta['count']
+        self.vectors = np.memmap(os.path.join(path, 'vectors.f32'), dtype=np.float32, mode='r',
+                                 shape=(self.count, self.meta['dim']))
+        self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.rows = np.load(os.path.join(path, 'rows.npy'), mmap_mode='r')
+        self.columns = payload_columns(os.path.join(path, 'columns'))
+
+    def search(self, vector, limit, nprobe=None, accept=None):
+        # accept(position) filters the candidates, they are checked best first until limit of them pass
+        query = normalize(np.asarray(vector, dtype=np.float32))
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        centroid_scores = self.centroids @ query
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+
+        scores = []
+        positions = []
+        for cluster in probe:
+            start, end = self.offsets[cluster], self.offsets[cluster + 1]
+            if end > start:
+                scores.append(self.vectors[start:end] @ query)
+                positions.append(np.arange(start, end))
+        if len(scores) == 0:
+            return [], []
+        scores = np.concatenate(scores)
+        positions = np.concatenate(positions)
+
+        if accept is not None:
+            top = []
+            for i in np.argsort(-scores):
+                if accept(positions[i]):
+                    top.append(i)
+                    if len(top) == limit:
+                        break
+            return positions[top], scores[top]
+
+        limit = min(limit, len(scores))
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return positions[top], scores[top]
+
+    def payload(self, position, keys=None):
+        return self.columns.get(int(self.rows[position]), keys)
+
+    def point(self, position, score, with_payload=True):
+        row = int(self.rows[position])
+        payload = self.columns.get(row) if with_payload else self.columns.get(row, {'__id__'})
+        point_id = payload.pop('__id__')
+        return qdrant_models.ScoredPoint(id=point_id, version=0, score=float(score),
+                                         payload=payload if with_payload else None)
+
+
+def is_empty_filter(query_filter):
+    # llama_index sends Filter(must=[]) with every query, that filters nothing
+    return query_filter is None or not any([query_filter.must, query_filter.should, query_filter.must_not])
+
+
+def as_list(conditions):
+    if conditions is None:
+        return []
+    return conditions if isinstance(conditions, list) else [conditions]
+
+
+def filter_keys(query_filter):
+    # the payload keys a filter reads, only those columns get decoded
+    keys = {'__id__'}
+    for condition in as_list(query_filter.must) + as_list(query_filter.should) + as_list(query_filter.must_not):
+        if isinstance(condition, qdrant_models.Filter):
+            keys |= filter_keys(condition)
+        elif isinstance(condition, qdrant_models.FieldCondition):
+            keys.add(condition.key.split('.')[0])
+        elif isinstance(condition, qdrant_models.IsEmptyCondition):
+            keys.add(condition.is_empty.key.split('.')[0])
+        elif isinstance(condition, qdrant_models.IsNullCondition):
+            keys.add(condition.is_null.key.split('.')[0])
+    return keys
+
+
+def payload_values(payload, key):
+    # values under a dotted key, lists match if any of their elements does, like in Qdrant
+    values = [payload]
+    for part in key.split('.'):
+        next_values = []
+        for value in values:
+            if isinstance(value, dict) and part in value:
+                value = value[part]
+                next_values.extend(value if isinstance(value, list) else [value])
+        values = next_values
+    return values
+
+
+def match_field(condition, payload):
+    values = payload_values(payload, condition.key)
+    match = condition.match
+    if match is not None:
+        if isinstance(match, qdrant_models.MatchValue):
+            return match.value in values
+        if isinstance(match, qdrant_models.MatchAny):
+            return any(value in match.any for value in values)
+        if isinstance(match, qdrant_models.MatchExcept):
+            return not any(value in match.except_ for value in values)
+        if isinstance(match, qdrant_models.MatchText):
+            return any(isinstance(value, str) and match.text in value for value in values)
+    elif condition.range is not None:
+        bounds = condition.range
+        numbers = [value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool)]
+        return any((bounds.gt is None or value > bounds.gt) and (bounds.gte is None or value >= bounds.gte) and
+                   (bounds.lt is None or value < bounds.lt) and (bounds.lte is None or value <= bounds.lte)
+                   for value in numbers)
+    raise NotImplementedError(f'the local vector store does not support the condition {condition}')
+
+
+def match_condition(condition, payload):
+    if isinstance(condition, qdrant_models.Filter):
+        return match_filter(condition, payload)
+    if isinstance(condition, qdrant_models.FieldCondition):
+        return match_field(condition, payload)
+    if isinstance(condition, qdrant_models.HasIdCondition):
+        return any(str(point_id) == str(payload['__id__']) for point_id in condition.has_id)
+    if isinstance(condition, qdrant_models.IsEmptyCondition):
+        return len(payload_values(payload, condition.is_empty.key)) == 0
+    if isinstance(condition, qdrant_models.IsNullCondition):
+        return any(value is None for value in payload_values(payload, condition.is_null.key))
+    raise NotImplementedError(f'the local vector store does not support the condition {condition}')
+
+
+def match_filter(query_filter, payload):
+    if not all(match_condition(condition, payload) for condition in as_list(query_filter.must)):
+        return False
+    if any(match_condition(condition, payload) for condition in as_list(query_filter.must_not)):
+        return False
+    should = as_list(query_filter.should)
+    return len(should) == 0 or any(match_condition(condition, payload) for condition in should)
+
+
+class local_qdrant_client:
+    """Answers the part of the QdrantClient api Prompt Quill uses from local_vector_index folders.
+
+    It can be handed to QdrantVectorStore in place of a QdrantClient, so the
+    llama_index retriever and query engine work on it unchanged."""
+
+    def __init__(self, path, nprobe=16):
+        self.path = path
+        self.nprobe = nprobe
+        self.indexes = {}
+
+    def get_index(self, collection_name):
+        if collection_name not in self.indexes:
+            index_path = os.path.join(self.path, collection_name)
+            if not os.path.isfile(os.path.join(index_path, 'meta.json')):
+                raise ValueError(f'Collection {collection_name} not found in {self.path}')
+            self.indexes[collection_name] = local_vector_index(index_path, self.nprobe)
+        return self.indexes[collection_name]
+
+    def get_collections(self):
+        names = [name for name in os.listdir(self.path) if os.path.isfile(os.path.join(self.path, name, 'meta.json'))] if os.path.isdir(self.path) else []
+        return SimpleNamespace(collections=[SimpleNamespace(name=name) for name in names])
+
+    def collection_exists(self, collection_name):
+        return os.path.isfile(os.path.join(self.path, collection_name, 'meta.json'))
+
+    def get_collection(self, collection_name):
+        index = self.get_index(collection_name)
+        return SimpleNamespace(status='green', points_count=index.count, vectors_count=index.count,
+                               indexed_vectors_count=index.count)
+
+    def search(self, collection_name, query_vector, limit=10, query_filter=None, with_payload=True,
+               search_params=None, **kwargs):
+        index = self.get_index(collection_name)
+        nprobe = None
+        if search_params is not None and getattr(search_params, 'hnsw_ef', None):
+            # hnsw_ef is the knob for a wider search in Qdrant, here it widens the probed clusters
+            nprobe = max(self.nprobe, int(search_params.hnsw_ef) // 8)
+        if is_empty_filter(query_filter):
+            positions, scores = index.search(query_vector, limit, nprobe)
+        else:
+            keys = filter_keys(query_filter)
+            accept = lambda position: match_filter(query_filter, index.payload(position, keys))
+            positions, scores = index.search(query_vector, limit, nprobe, accept)
+            if len(positions) < limit:
+                # a narrow filter can leave the probed clusters short, then every cluster is searched
+                positions, scores = index.search(query_vector, limit, len(index.centroids), accept)
+        return [index.point(position, score, bool(with_payload)) for position, score in zip(positions, scores)]
+
+    def search_batch(self, collection_name, requests, **kwargs):
+        return [self.search(collection_name, request.vector, limit=request.limit, query_filter=request.filter,
+                            with_payload=request.with_payload, search_params=request.params)
+                for request in requests]
@@ -0,0 +1,46 @@
+import gc
+import os
+from collections import OrderedDict
+
+
+class model_registry:
+    """Keeps loaded LLMs resident so switching back to one does not reload it from disk.
+
+    At most max_models stay loaded, and as long as more than one is loaded their
+    model files together have to fit into max_bytes (0 means no byte limit)."""
+
+    def __init__(self, max_models=1, max_bytes=0):
+        self.models = OrderedDict()
+        self.max_models = max(int(max_models), 1)
+        self.max_bytes = int(max_bytes)
+
+    def model_size(self, llm):
+        try:
+            return os.path.getsize(llm.model_path)
+        except (OSError, TypeError):
+            return 0
+
+    def loaded_bytes(self):
+        return sum(self.model_size(llm) for llm in self.models.values())
+
+    def release(self, key):
+        llm = self.models.pop(key)
+        llm._model = None
+        del llm
+        gc.collect()
+
+    def get(self, key, factory):
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key]
+
+        # make room before loading so two large models never share the RAM by accident
+        while len(self.models) >= self.max_models:
+            self.release(next(iter(self.models)))
+
+        llm = factory()
+        self.models[key] = llm
+
+        while self.max_bytes > 0 and len(self.models) > 1 and self.loaded_bytes() > self.max_bytes:
+            self.release(next(iter(self.models)))
+        return llm
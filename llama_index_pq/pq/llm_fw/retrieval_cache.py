@@ -0,0 +1,89 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class retrieval_cache:
+    """Remembers query embeddings and the nodes Qdrant returned for them.
+
+    Entries are keyed by (normalized query, top_k, collection) and dropped
+    least recently used first or once they are older than ttl seconds. The
+    point count of the collection is checked at most every check_seconds,
+    if the indexer added or removed points everything cached is dropped."""
+
+    def __init__(self, max_entries=1024, ttl=600, check_seconds=30, points_count=None):
+        self.entries = OrderedDict()
+        self.embeddings = OrderedDict()
+        self.max_entries = max(int(max_entries), 1)
+        self.ttl = ttl
+        self.check_seconds = check_seconds
+        self.points_count = points_count
+        self.collection_counts = {}
+        self.last_check = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def normalize(self, query):
+        return ' '.join(query.lower().split())
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.embeddings.clear()
+
+    def check_collection(self, collection):
+        now = time.time()
+        if self.points_count is None or now - self.last_check.get(collection, 0) < self.check_seconds:
+            return
+        self.last_check[collection] = now
+        try:
+            count = self.points_count(collection)
+        except Exception:
+            return
+        if collection in self.collection_counts and self.collection_counts[collection] != count:
+            print(f'retrieval cache: {collection} changed, dropping cached results')
+            self.clear()
+        self.collection_counts[collection] = count
+
+    def get(self, query, top_k, collection):
+        key = (self.normalize(query), int(top_k), collection)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def get_embedding(self, query):
+        key = self.normalize(query)
+        with self.lock:
+            embedding = self.embeddings.get(key)
+            if embedding is not None:
+                self.embeddings.move_to_end(key)
+            return embedding
+
+    def put(self, query, top_k, collection, embedding, nodes):
+        normalized = self.normalize(query)
+        with self.lock:
+            self.entries[(normalized, int(top_k), collection)] = (time.time(), embedding, nodes)
+            self.entries.move_to_end((normalized, int(top_k), collection))
+            self.embeddings[normalized] = embedding
+            self.embeddings.move_to_end(normalized)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            while len(self.embeddings) > self.max_entries:
+                self.embeddings.popitem(last=False)
+
+    @property
+    def stats(self):
+        requests = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests > 0 else 0.0,
+                'entries': len(self.entries)}
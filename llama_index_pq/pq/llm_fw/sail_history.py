@@ -0,0 +1,40 @@
+import numpy as np
+
+
+class sail_history:
+    """The prompts a sail already visited.
+
+    The texts live in a set for the exact check, their normalized embeddings
+    (if the sail computes them) in a matrix that doubles when it is full, so
+    the similarity of all candidates to everything visited is one matmul."""
+
+    def __init__(self):
+        self.texts = set()
+        self.vectors = None
+        self.count = 0
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __contains__(self, text):
+        return text in self.texts
+
+    def add(self, text, embedding=None):
+        self.texts.add(text)
+        if embedding is None:
+            return
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if self.vectors is None:
+            self.vectors = np.empty((64, embedding.shape[0]), dtype=np.float32)
+        elif self.count == self.vectors.shape[0]:
+            self.vectors = np.concatenate([self.vectors, np.empty_like(self.vectors)])
+        self.vectors[self.count] = embedding / max(np.linalg.norm(embedding), 1e-12)
+        self.count += 1
+
+    def max_similarity(self, embeddings):
+        # cosine similarity of every candidate to its closest visited prompt, 0 while nothing was visited
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.count == 0:
+            return np.zeros(len(embeddings), dtype=np.float32)
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return (embeddings @ self.vectors[:self.count].T).max(axis=1)
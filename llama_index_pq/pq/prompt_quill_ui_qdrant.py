@@ -12,27 +12,35 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 
+from startup_profile import profile
 import os
 import globals
 from settings.io import settings_io
 g = globals.get_globals()
-g.settings_data = settings_io().load_settings()
+with profile.stage('settings'):
+    g.settings_data = settings_io().load_settings()
 
 
-import gradio as gr
+with profile.stage('gradio import'):
+    import gradio as gr
 
-from llm_fw.llama_cpp_hijack import llama_cpp_hijack
+with profile.stage('llama_cpp import'):
+    from llm_fw.llama_cpp_hijack import llama_cpp_hijack
 
-hijack = llama_cpp_hijack()
+    hijack = llama_cpp_hijack()
 
 
 
-from ui import ui_actions,ui_staff
+with profile.stage('ui import'):
+    from ui import ui_actions,ui_staff
 from style import style
 css = style
 
-ui = ui_staff()
-ui_code = ui_actions()
+with profile.stage('ui_staff'):
+    ui = ui_staff()
+# starts loading llama_index, the embedder and the LLM in the background
+with profile.stage('ui_actions'):
+    ui_code = ui_actions()
 
 max_top_k = 50
 textboxes = []
@@ -48,6 +56,8 @@ with gr.Blocks(css=css, title='Prompt Quill') as pq_ui:
         # Title element (adjust font size and styling with CSS if needed)
         gr.Markdown("**Prompt Quill**", elem_classes="app-title")  # Add unique ID for potential CSS styling
 
+        startup_status = gr.Markdown(ui_code.interface.get_status())
+
     with gr.Tab("Chat") as chat:
         with gr.Row():
             translate = gr.Checkbox(label="Translate", info="Translate your native language to english?",
@@ -458,8 +468,14 @@ with gr.Blocks(css=css, title='Prompt Quill') as pq_ui:
 
                 np_submit_button.click(ui_code.set_neg_prompt,neg_prompt_text,None)
 
+    pq_ui.load(ui_code.startup_status, None, startup_status)
+
     #pq_ui.queue(max_size=20)
 
+profile.mark('ui built')
+
 
 if __name__ == "__main__":
-    pq_ui.launch(favicon_path='logo/favicon32x32.ico', inbrowser=True, server_name="0.0.0.0")  # share=True
+    pq_ui.launch(favicon_path='logo/favicon32x32.ico', inbrowser=True, server_name="0.0.0.0", prevent_thread_lock=True)  # share=True
+    profile.mark('first page')
+    pq_ui.block_thread()
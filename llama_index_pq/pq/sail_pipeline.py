@@ -0,0 +1,60 @@
+import queue
+import threading
+
+
+class sail_pipeline:
+    """Runs the prompt side of a sail (retrieval, LLM, next target) in a worker thread.
+
+    The worker stays up to lookahead prompts ahead of the caller, so the next
+    prompt is usually ready by the time the image backend wants it. With a
+    lookahead of 0 the steps simply run in the calling thread."""
+
+    def __init__(self, steps, lookahead=2):
+        self.steps = steps
+        self.lookahead = int(lookahead)
+        self.queue = queue.Queue(maxsize=max(self.lookahead, 1))
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def run(self):
+        try:
+            for step in self.steps:
+                if not self.put(step):
+                    return
+        except Exception as e:
+            self.put(e)
+        finally:
+            self.put(None)
+
+    def put(self, item):
+        # a full queue is re-checked now and then so stop() never leaves the worker hanging
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        if self.lookahead <= 0:
+            yield from self.steps
+            return
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def stop(self):
+        # prompts made ahead are dropped, a running LLM call is waited for, so nothing
+        # else drives the model from a second thread once stop returns
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.steps.close()
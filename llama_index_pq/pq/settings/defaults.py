@@ -8,6 +8,23 @@ default = {
     "max output Tokens": 200,
     "top_k": 5,
     'Instruct Model': False,
+    'llm_state_cache': True,
+    'llm_state_cache_size_gb': 4,
+    'resident_models': 1,
+    'resident_models_ram_gb': 0,
+    'llm_prompt_lookup': False,
+    'llm_prompt_lookup_max_ngram': 3,
+    'llm_prompt_lookup_num_pred_tokens': 10,
+    'retrieval_cache': True,
+    'retrieval_cache_size': 1024,
+    'retrieval_cache_ttl': 600,
+    'retrieval_cache_check_seconds': 30,
+    'embedding_cache': True,
+    'vector_store': 'qdrant',
+    'local_index_path': 'local_index',
+    'local_index_nprobe': 16,
+    'quantization_rescore': True,
+    'quantization_oversampling': 2.0,
 
     'civitai_Air': 'urn:air:sd1:checkpoint:civitai:4201@130072',
     "civitai_Steps": 20,
@@ -31,10 +48,14 @@ default = {
     "automa_Width": 768,
     "automa_Height": 512,
     "automa_url": "http://localhost:7860",
+    "automa_urls": [],
+    "automa_max_pending": 2,
     "automa_save": True,
     "automa_batch": 1,
     "automa_n_iter":1,
     "automa_save_on_api_host":False,
+    "image_writer_max_pending":32,
+    "gallery_thumbnail_size":768,
     "automa_adetailer_enable":False,
     'automa_ad_use_inpaint_width_height':False,
     'automa_ad_model':'face_yolov8n.pt',
@@ -55,6 +76,10 @@ default = {
     "sail_add_search":False,
     "sail_search":"",
     "sail_max_gallery_size":10,
+    "sail_gallery_max_mb":64,
+    "sail_novelty":0.0,
+    "sail_near_duplicate_threshold":0.95,
+    "sail_lookahead":2,
 
 
     'selected_template': 'prompt_template_b',
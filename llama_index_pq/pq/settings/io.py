@@ -1,7 +1,81 @@
 import json
 import os
+import atexit
+import threading
 from settings.defaults import default
 
+settings_file = 'pq/settings/settings.dat'
+
+
+class settings_store:
+    """The settings as the process sees them, shared by every settings_io.
+
+    write() only schedules a flush, delay seconds later the values are
+    compared with what is on disk and the file is rewritten atomically if
+    any of them changed, so a dragged slider ends up as one write instead
+    of one per step. The stat of the file after the last read or write
+    tells load_settings if anything else touched it."""
+
+    def __init__(self, path, delay=1.0):
+        self.path = path
+        self.delay = delay
+        self.settings = None
+        self.saved = {}
+        self.stat = None
+        self.timer = None
+        self.lock = threading.RLock()
+        atexit.register(self.flush)
+
+    def file_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def changed_on_disk(self):
+        return self.file_stat() != self.stat
+
+    def read(self):
+        with self.lock:
+            with open(self.path, 'r') as f:
+                self.settings = json.loads(f.read())
+            self.saved = {key: json.dumps(value) for key, value in self.settings.items()}
+            self.stat = self.file_stat()
+            return self.settings
+
+    def dirty(self, settings):
+        if settings.keys() != self.saved.keys():
+            return True
+        return any(self.saved[key] != json.dumps(value) for key, value in settings.items())
+
+    def write(self, settings):
+        with self.lock:
+            self.settings = settings
+            # whether anything really changed is only checked once the delay is over
+            if self.timer is not None:
+                return
+            self.timer = threading.Timer(self.delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            if self.settings is None or not self.dirty(self.settings):
+                return
+            data = json.dumps(self.settings)
+            tmp_file = f'{self.path}.tmp'
+            with open(tmp_file, 'w') as f:
+                f.write(data)
+            os.replace(tmp_file, self.path)
+            self.saved = {key: json.dumps(value) for key, value in self.settings.items()}
+            self.stat = self.file_stat()
+
+
+_store = settings_store(settings_file)
+
+
 class settings_io:
 
 
@@ -14,29 +88,21 @@ class settings_io:
         self.write_settings(self.settings)
 
     def check_missing_seettings(self):
-        missing = 0
         for key in self.default.keys():
             if key not in self.settings:
                 self.settings[key] = self.default[key]
-                missing += 1
-        if missing != 0:
-            self.write_settings(self.settings)
         self.update_settings_with_defaults()
 
     def load_settings(self):
-        if os.path.isfile('pq/settings/settings.dat'):
-            f = open('pq/settings/settings.dat','r')
-            self.settings = json.loads(f.read())
-            f.close()
+        # as long as nobody else wrote the file the settings in memory are still current
+        if _store.settings is not None and not _store.changed_on_disk():
+            self.settings = _store.settings
+            return self.settings
+        if os.path.isfile(settings_file):
+            self.settings = _store.read()
             self.check_missing_seettings()
         return self.settings
 
 
     def write_settings(self, settings):
-        f = open('pq/settings/settings.dat','w')
-        f.write(json.dumps(settings))
-        f.close()
-
-
-
-
+        _store.write(settings)
@@ -0,0 +1,67 @@
+import time
+import threading
+from contextlib import contextmanager
+
+
+class startup_profile:
+    """Wall clock of the startup stages, reported in the layout of python -X importtime.
+
+    Stages can nest and run in several threads at once, every stage is timed
+    from the moment this module was imported. Marks like the first page or
+    the first answer are kept once, the first time they happen."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = []
+        self.marks = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def now(self):
+        return time.perf_counter() - self.start
+
+    @contextmanager
+    def stage(self, name):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        stack = self.local.stack
+        parent = stack[-1] if len(stack) > 0 else None
+        record = {'name': name, 'thread': threading.current_thread().name, 'depth': len(stack),
+                  'start': self.now(), 'end': None, 'children': 0.0}
+        with self.lock:
+            self.stages.append(record)
+        stack.append(record)
+        try:
+            yield
+        finally:
+            stack.pop()
+            record['end'] = self.now()
+            if parent is not None:
+                parent['children'] += record['end'] - record['start']
+
+    def mark(self, name):
+        with self.lock:
+            if name in self.marks:
+                return False
+            self.marks[name] = self.now()
+        print(f'startup: {name} after {self.marks[name]:.2f}s')
+        return True
+
+    def report(self):
+        lines = ['startup: self [ms] | cumulative [ms] | thread | stage']
+        with self.lock:
+            stages = list(self.stages)
+            marks = dict(self.marks)
+        for record in stages:
+            if record['end'] is None:
+                lines.append(f'startup: {"":>9} | {"running":>16} | {record["thread"]} | {"  " * record["depth"]}{record["name"]}')
+                continue
+            cumulative = (record['end'] - record['start']) * 1000
+            own = cumulative - record['children'] * 1000
+            lines.append(f'startup: {own:9.0f} | {cumulative:16.0f} | {record["thread"]} | {"  " * record["depth"]}{record["name"]}')
+        for name, seconds in sorted(marks.items(), key=lambda item: item[1]):
+            lines.append(f'startup: {name} after {seconds:.2f}s')
+        print('\n'.join(lines))
+
+
+profile = startup_profile()
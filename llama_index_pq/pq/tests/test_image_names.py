@@ -0,0 +1,35 @@
+import os
+import sys
+import base64
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('PIL')
+
+from generators.automatics import image_writer as image_writer_module
+from generators.automatics.image_writer import generated_image, image_names, image_writer
+
+
+def test_responses_in_the_same_second_get_their_own_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_writer_module.time, 'time', lambda: 1700000000.0)
+    names = image_names(str(tmp_path), 'txt2img')
+    writer = image_writer()
+
+    responses = [[base64.b64encode(f'response {job} image {index}'.encode()) for index in range(2)]
+                 for job in range(2)]
+    images = []
+    for response in responses:
+        paths = names.paths(len(response))
+        for index, image in enumerate(response):
+            img = generated_image(image, paths[index])
+            writer.submit(img)
+            images.append(img)
+    for img in images:
+        img.written.result()
+
+    assert len({img.path for img in images}) == 4
+    for img in images:
+        with open(img.path, 'rb') as f:
+            assert f.read() == img.data
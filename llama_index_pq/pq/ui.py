@@ -4,19 +4,27 @@ import gradio as gr
 import base64
 from datetime import datetime
 import math
-from PIL import Image
-from io import BytesIO
+import numpy as np
 import time
 import re
+import json
+import hashlib
+import itertools
+import concurrent.futures
 from collections import deque
 
 from generators.civitai.client import civitai_client
 from generators.hordeai.client import hordeai_client
 from generators.automatics.client import automa_client
+from generators.automatics.async_client import automa_async_client
+from generators.automatics.image_writer import generated_image, image_names, image_writer
+from generators.automatics.thumbnail_cache import thumbnail_cache
 from generators.hordeai.client import hordeai_models
 from settings.io import settings_io
+from sail_pipeline import sail_pipeline
 
 from llm_fw import llm_interface_qdrant
+from llm_fw.sail_history import sail_history
 
 out_dir = 'api_out'
 out_dir_t2t = os.path.join(out_dir, 'txt2txt')
@@ -26,6 +34,7 @@ os.makedirs(out_dir_i2t, exist_ok=True)
 out_dir_t2i = os.path.join(out_dir, 'txt2img')
 out_dir_i2i = os.path.join(out_dir, 'img2img')
 os.makedirs(out_dir_t2i, exist_ok=True)
+out_dir_thumbnails = os.path.join(out_dir, 'thumbnails')
 
 
 
@@ -37,10 +46,19 @@ class ui_actions:
         self.settings_io = settings_io()
         self.max_top_k = 50
         self.automa_client = automa_client()
+        self.automa_async = automa_async_client()
+        self.image_writer = image_writer(max_pending=self.g.settings_data['image_writer_max_pending'])
+        self.t2i_names = image_names(out_dir_t2i, 'txt2img')
 
     def run_llm_response(self,query, history):
         return self.interface.run_llm_response(query, history)
 
+    def startup_status(self):
+        # the models load in the background, the page shows how far they are until they are ready
+        while not self.interface.ready.wait(1):
+            yield self.interface.get_status()
+        yield self.interface.get_status()
+
     def set_llm_settings(self, model, temperature, n_ctx, n_gpu_layers, max_tokens, top_k, instruct):
         self.g.settings_data['LLM Model'] = model
         self.g.settings_data['Temperature'] = temperature
@@ -216,12 +234,15 @@ class ui_actions:
 
         response = self.automa_client.request_generation(prompt, negative_prompt, self.g.settings_data)
         images = []
-        for index, image in enumerate(response.get('images')):
-            img = Image.open(BytesIO(base64.b64decode(image))).convert('RGB')
+        response_images = response.get('images')
+        paths = self.t2i_names.paths(len(response_images))
+        for index, image in enumerate(response_images):
+            # each image is decoded once, the png bytes go to the writer as they are
+            img = generated_image(image, paths[index])
+            response_images[index] = None
             if save:
-                save_path = os.path.join(out_dir_t2i, f'txt2img-{self.timestamp()}-{index}.png')
-                self.automa_client.decode_and_save_base64(image, save_path)
-            images.append(img)
+                self.image_writer.submit(img)
+            images.append(img.thumbnail(self.g.settings_data['gallery_thumbnail_size']))
         yield images
 
     
@@ -237,8 +258,15 @@ class ui_actions:
         all_response = ''
         output = ''
         n = 0
+        # all images go out at once over the pooled connections, the captions come back in order
+        futures = []
         for file in image_filenames:
-            response = self.run_automa_interrogation(file[0],url)
+            with open(file[0], mode='rb') as fp:
+                futures.append(self.automa_async.request_interrogation(base64.b64encode(fp.read()).decode('utf-8'), url))
+        for future in futures:
+            result = future.result()
+            response = result['caption'] if result != '' else ''
+            self.g.context_prompt = response
             if all_response == '':
                 all_response = response
             else:
@@ -257,9 +285,9 @@ class ui_actions:
 
 
     def get_next_target(self, nodes):
-        target_dict = self.interface.get_query_texts(nodes)
+        texts, scores, embeddings = self.interface.get_query_texts(nodes)
 
-        if len(target_dict.keys()) < self.g.settings_data['sail_depth']:
+        if len(texts) < self.g.settings_data['sail_depth']:
             self.g.settings_data['sail_depth'] = self.sail_depth_start + len(self.g.sail_history)
 
         if self.g.settings_data['sail_sinus']:
@@ -269,16 +297,25 @@ class ui_actions:
             if self.g.settings_data['sail_depth'] < 0:
                 self.g.settings_data['sail_depth'] = 1
 
-        if len(target_dict.keys()) > 0:
+        if len(texts) > 0:
+
+            if embeddings is not None:
+                # near duplicates of visited prompts are dropped, the rest is pushed away from the visited ones
+                similarity = self.g.sail_history.max_similarity(embeddings)
+                keep = similarity < self.g.settings_data['sail_near_duplicate_threshold']
+                if keep.any():
+                    texts = [text for text, k in zip(texts, keep) if k]
+                    scores, embeddings, similarity = scores[keep], embeddings[keep], similarity[keep]
+                novelty = self.g.settings_data['sail_novelty'] * similarity
+                scores = scores + novelty if self.g.settings_data['sail_target'] else scores - novelty
 
             if self.g.settings_data['sail_target']:
-                out =  target_dict[min(target_dict.keys())]
-                self.g.sail_history.append(out)
-                return out
+                index = int(np.argmin(scores))
             else:
-                out =  target_dict[max(target_dict.keys())]
-                self.g.sail_history.append(out)
-                return out
+                index = int(np.argmax(scores))
+            out = texts[index]
+            self.g.sail_history.add(out, embeddings[index] if embeddings is not None else None)
+            return out
         else:
             return -1
 
@@ -286,33 +323,65 @@ class ui_actions:
         return self.automa_client.check_avail(self.g.settings_data['automa_url'])
 
     def sail_automa_gen(self, query):
-        return self.automa_client.request_generation(query,
-                                                self.g.settings_data['negative_prompt'],
-                                                self.g.settings_data)
-
-
-
-    def run_t2t_sail(self):
-        self.g.sail_running = True
-        self.g.sail_history = []
-        self.sail_depth_start = self.g.settings_data['sail_depth']
-        self.sail_sinus_count = 1.0
-        sail_log = ''
-        query = self.g.settings_data['sail_text']
-        images = deque(maxlen=int(self.g.settings_data['sail_max_gallery_size']))
+        return self.automa_async.request_generation(query,
+                                                    self.g.settings_data['negative_prompt'],
+                                                    self.g.settings_data)
+
+    def collect_sail_images(self, pending, wait):
+        # hands back (job, response) of every finished job, if wait is set it blocks until at least one is done
+        if wait:
+            concurrent.futures.wait([future for job, future in pending], return_when=concurrent.futures.FIRST_COMPLETED)
+        done = []
+        running = []
+        for job, future in pending:
+            if future.done():
+                done.append((job, future.result()))
+            else:
+                running.append((job, future))
+        pending[:] = running
+        return done
+
+    def finish_sail_images(self, pending):
+        # after the last step the open jobs are awaited, after a stop they are dropped
+        if self.g.sail_running is False:
+            for job, future in pending:
+                future.cancel()
+            pending.clear()
+        while len(pending) > 0:
+            for job in self.collect_sail_images(pending, True):
+                yield job
+
+    def decode_sail_images(self, response):
+        # the images are written in the background, the gallery decodes them only when it shows them
+        images = []
+        if response == '':
+            return images
+        response_images = response.get('images')
+        paths = self.t2i_names.paths(len(response_images))
+        for index, image in enumerate(response_images):
+            img = generated_image(image, paths[index])
+            response_images[index] = None
+            self.image_writer.submit(img)
+            images.append(img)
+        return images
 
-        filename = os.path.join(out_dir_t2t, f'Journey_log_{time.strftime("%Y%m%d-%H%M%S")}.txt')
+    def show_sail_image(self, img):
+        # the show tab gets the saved png as a file, gradio does not have to encode it again
+        if img.written.exception() is None:
+            return img.path
+        return img.image()
 
-        if self.g.settings_data['translate']:
-            query = self.interface.translate(self.g.settings_data['sail_text'])
 
 
+    def sail_prompts(self, query):
+        # the prompt side of run_t2t_sail, it runs ahead of the images in a sail_pipeline
         for n in range(self.g.settings_data['sail_width']):
 
             if self.g.settings_data['sail_add_search']:
                 query = f'{self.g.settings_data["sail_search"]}, {self.g.settings_data["sail_text"]}'
 
-            prompt = self.interface.retrieve_query(self.g.settings_data['sail_text'])
+            prompt, nodes = self.interface.retrieve_query_with_targets(self.g.settings_data['sail_text'], query,
+                                                                       self.g.settings_data['sail_depth'])
 
             if '\n' in prompt:
                 prompt = re.sub(r'.*\n', '', prompt)
@@ -320,82 +389,140 @@ class ui_actions:
             if self.g.settings_data['sail_add_style']:
                 prompt = f'{self.g.settings_data["sail_style"]}, {prompt}'
 
-            self.interface.log_raw(filename,f'{prompt}\n{n} ----------')
+            yield n, prompt
 
-            sail_log = sail_log + f'{prompt}\n{n} ----------\n'
+            self.g.settings_data['sail_text'] = self.get_next_target(nodes)
+            if self.g.settings_data['sail_text'] == -1:
+                self.sail_finished_early = n
+                break
+            if self.g.sail_running is False:
+                break
 
-            nodes = self.interface.retrieve_top_k_query(query, self.g.settings_data['sail_depth'])
-            
-            if self.g.settings_data['sail_generate']:
-                response = self.sail_automa_gen(prompt)
+    def show_sail_prompts(self, query):
+        # the prompt side of run_t2t_show_sail
+        for n in range(self.g.settings_data['sail_width']):
 
-                for index, image in enumerate(response.get('images')):
-                    img = Image.open(BytesIO(base64.b64decode(image))).convert('RGB')
-                    save_path = os.path.join(out_dir_t2i, f'txt2img-{self.timestamp()}-{index}.png')
-                    self.automa_client.decode_and_save_base64(image, save_path)
-                    images.append(img)
+            if self.g.settings_data['sail_add_search']:
+                query = f"{self.g.settings_data['sail_search']}, {query}"
 
-                yield sail_log,list(images)
+            prompt, nodes = self.interface.retrieve_query_with_targets(query, query, self.g.settings_data['sail_depth'])
 
-            else:
-                yield sail_log,[]
+            if '\n' in prompt:
+                prompt = re.sub(r'.*\n', '', prompt)
 
-            self.g.settings_data['sail_text'] = self.get_next_target(nodes)
-            if self.g.settings_data['sail_text'] == -1:
-                self.interface.log_raw(filename,f'{n} sail is finished early due to rotating context')
+            if self.g.settings_data['sail_add_style']:
+                prompt = f'{self.g.settings_data["sail_style"]}, {prompt}'
+
+            yield n, prompt
+
+            query = self.get_next_target(nodes)
+            if query == -1:
+                self.sail_finished_early = n
                 break
             if self.g.sail_running is False:
                 break
 
-    def run_t2t_show_sail(self):
+    def run_t2t_sail(self):
         self.g.sail_running = True
-        self.g.settings_data['automa_batch'] = 1
-        self.g.settings_data['automa_n_iter'] = 1
-        self.g.sail_history = []
+        self.g.sail_history = sail_history()
         self.sail_depth_start = self.g.settings_data['sail_depth']
         self.sail_sinus_count = 1.0
+        self.sail_finished_early = None
         sail_log = ''
         query = self.g.settings_data['sail_text']
+        pending = []
 
         filename = os.path.join(out_dir_t2t, f'Journey_log_{time.strftime("%Y%m%d-%H%M%S")}.txt')
+        gallery = thumbnail_cache(os.path.join(out_dir_thumbnails, f'Journey_{time.strftime("%Y%m%d-%H%M%S")}'),
+                                  size=self.g.settings_data['gallery_thumbnail_size'],
+                                  max_items=self.g.settings_data['sail_max_gallery_size'],
+                                  max_bytes=self.g.settings_data['sail_gallery_max_mb'] * 1024 * 1024)
 
         if self.g.settings_data['translate']:
-            query = self.interface.translate(query)
+            query = self.interface.translate(self.g.settings_data['sail_text'])
 
+        # the next prompts are generated while the images of the last ones render
+        n = -1
+        pipeline = sail_pipeline(self.sail_prompts(query), self.g.settings_data['sail_lookahead'])
+        try:
+            for n, prompt in pipeline:
 
-        for n in range(self.g.settings_data['sail_width']):
+                self.interface.log_raw(filename,f'{prompt}\n{n} ----------')
 
-            if self.g.settings_data['sail_add_search']:
-                query = f"{self.g.settings_data['sail_search']}, {query}"
+                sail_log = sail_log + f'{prompt}\n{n} ----------\n'
 
-            prompt = self.interface.retrieve_query(query)
+                if self.g.settings_data['sail_generate']:
+                    # the next step goes on while the image renders, only too many open jobs make it wait
+                    pending.append(((n, prompt), self.sail_automa_gen(prompt)))
+                    wait = len(pending) > self.g.settings_data['automa_max_pending']
+                    for (step, job_prompt), response in self.collect_sail_images(pending, wait):
+                        gallery.add_step(step, job_prompt, self.decode_sail_images(response))
 
-            if '\n' in prompt:
-                prompt = re.sub(r'.*\n', '', prompt)
+                    yield sail_log,gallery.gallery()
 
-            if self.g.settings_data['sail_add_style']:
-                prompt = f'{self.g.settings_data["sail_style"]}, {prompt}'
+                else:
+                    yield sail_log,[]
 
-            self.interface.log_raw(filename,f'{prompt}\n{n} ----------')
+                if self.g.sail_running is False:
+                    break
+        finally:
+            pipeline.stop()
 
-            sail_log = sail_log + f'{prompt}\n{n} ----------\n'
-            nodes = self.interface.retrieve_top_k_query(query, self.g.settings_data['sail_depth'])
-            if self.g.settings_data['sail_generate']:
-                response = self.sail_automa_gen(prompt)
+        # prompts the worker made ahead of a stop were never shown, so only log the end if it was reached
+        if self.sail_finished_early == n:
+            self.interface.log_raw(filename,f'{self.sail_finished_early} sail is finished early due to rotating context')
 
-                for index, image in enumerate(response.get('images')):
-                    img = Image.open(BytesIO(base64.b64decode(image))).convert('RGB')
-                    save_path = os.path.join(out_dir_t2i, f'txt2img-{self.timestamp()}-{index}.png')
-                    self.automa_client.decode_and_save_base64(image, save_path)
-                    yield prompt,img
-            else:
-                yield prompt,None
-            query = self.get_next_target(nodes)
-            if query == -1:
-                self.interface.log_raw(filename,f'{n} sail is finished early due to rotating context')
-                break
-            if self.g.sail_running is False:
-                break
+        for (step, job_prompt), response in self.finish_sail_images(pending):
+            gallery.add_step(step, job_prompt, self.decode_sail_images(response))
+            yield sail_log,gallery.gallery()
+
+    def run_t2t_show_sail(self):
+        self.g.sail_running = True
+        self.g.settings_data['automa_batch'] = 1
+        self.g.settings_data['automa_n_iter'] = 1
+        self.g.sail_history = sail_history()
+        self.sail_depth_start = self.g.settings_data['sail_depth']
+        self.sail_sinus_count = 1.0
+        self.sail_finished_early = None
+        sail_log = ''
+        query = self.g.settings_data['sail_text']
+        pending = []
+
+        filename = os.path.join(out_dir_t2t, f'Journey_log_{time.strftime("%Y%m%d-%H%M%S")}.txt')
+
+        if self.g.settings_data['translate']:
+            query = self.interface.translate(query)
+
+        n = -1
+        pipeline = sail_pipeline(self.show_sail_prompts(query), self.g.settings_data['sail_lookahead'])
+        try:
+            for n, prompt in pipeline:
+
+                self.interface.log_raw(filename,f'{prompt}\n{n} ----------')
+
+                sail_log = sail_log + f'{prompt}\n{n} ----------\n'
+                if self.g.settings_data['sail_generate']:
+                    # every image is shown together with the prompt it was made from
+                    pending.append((prompt, self.sail_automa_gen(prompt)))
+                    wait = len(pending) > self.g.settings_data['automa_max_pending']
+                    for job_prompt, response in self.collect_sail_images(pending, wait):
+                        for img in self.decode_sail_images(response):
+                            yield job_prompt,self.show_sail_image(img)
+                else:
+                    yield prompt,None
+
+                if self.g.sail_running is False:
+                    break
+        finally:
+            pipeline.stop()
+
+        # prompts the worker made ahead of a stop were never shown, so only log the end if it was reached
+        if self.sail_finished_early == n:
+            self.interface.log_raw(filename,f'{self.sail_finished_early} sail is finished early due to rotating context')
+
+        for job_prompt, response in self.finish_sail_images(pending):
+            for img in self.decode_sail_images(response):
+                yield job_prompt,self.show_sail_image(img)
 
     def stop_t2t_sail(self):
         self.g.sail_running = False
@@ -449,25 +576,67 @@ class ui_actions:
         self.interface.reload_settings()
 
 
+    def batch_source(self, file):
+        # a replaced or edited input rarely keeps both its mtime and the hash of its first block
+        stat = os.stat(file)
+        with open(file, 'rb') as f:
+            head = hashlib.sha1(f.read(64 * 1024)).hexdigest()
+        return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns, 'source_head': head}
+
+    def read_batch_checkpoint(self, checkpoint_file, source):
+        if os.path.isfile(checkpoint_file):
+            try:
+                with open(checkpoint_file, 'r') as f:
+                    checkpoint = json.load(f)
+                if all(checkpoint[key] == value for key, value in source.items()):
+                    return checkpoint
+            except (OSError, ValueError, KeyError):
+                pass
+        return None
+
+    def write_batch_checkpoint(self, checkpoint_file, checkpoint):
+        with open(f'{checkpoint_file}.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(f'{checkpoint_file}.tmp', checkpoint_file)
+
     def run_batch(self, files):
-        output = ''
+        output = deque(maxlen=100)
         for file in files:
             filename = os.path.basename(file)
-            file_content = []
-            f = open(file,'r',encoding='utf8',errors='ignore')
-            file_content = f.readlines()
-            f.close()
-    
             outfile = os.path.join(out_dir_t2t,filename)
-            f = open(outfile,'a',encoding='utf8',errors='ignore')
-            n = 0
-            for query in file_content:
-                response= self.interface.run_llm_response_batch(query)
-                f.write(f'{response}\n')
-                output = f'{output}{response}\n{n} ---------\n'
-                n += 1
-                yield output
-            f.close()
+            checkpoint_file = f'{outfile}.ckpt'
+
+            # a checkpoint is only valid for the same input, it remembers how far the output file got
+            source = self.batch_source(file)
+            checkpoint = self.read_batch_checkpoint(checkpoint_file, source)
+            if checkpoint is None:
+                checkpoint = dict(source, lines_done=0,
+                                  output_offset=os.path.getsize(outfile) if os.path.isfile(outfile) else 0)
+                self.write_batch_checkpoint(checkpoint_file, checkpoint)
+            elif os.path.isfile(outfile):
+                with open(outfile, 'r+b') as out:
+                    out.truncate(checkpoint['output_offset'])
+            skipped = checkpoint['lines_done']
+
+            start = time.time()
+            with open(file,'r',encoding='utf8',errors='ignore') as source, open(outfile,'ab') as out:
+                queries = itertools.islice(source, skipped, None)
+                for response in self.interface.run_llm_response_batch_list(queries):
+                    out.write(f'{response}\n'.encode('utf8', errors='ignore'))
+                    out.flush()
+                    checkpoint['lines_done'] += 1
+                    checkpoint['output_offset'] = out.tell()
+                    self.write_batch_checkpoint(checkpoint_file, checkpoint)
+
+                    n = checkpoint['lines_done'] - 1
+                    output.append(f'{response}\n{n} ---------\n')
+                    rate = (n + 1 - skipped) / max(time.time() - start, 1e-6)
+                    status = f'{filename}: {n + 1} lines done, {rate:.2f} lines/sec'
+                    if skipped > 0:
+                        status = f'{status}, resumed after line {skipped}'
+                    yield f'{status}\n\n{"".join(output)}'
+
+            os.remove(checkpoint_file)
 
 
 
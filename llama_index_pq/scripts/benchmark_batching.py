@@ -0,0 +1,87 @@
+# Copyright 2023 osiworx
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# aggregate tokens/s of the continuous batching scheduler at 1, 4 and 8 concurrent clients,
+# against the same requests run one after the other like the server does without n_slots.
+# needs the llama_cpp folder of llama-cpp_windows in site-packages, see its Readme.md
+
+import sys
+import time
+import threading
+
+from llama_cpp import Llama
+from llama_cpp.llama_batching import LlamaBatchScheduler
+
+
+model_path = sys.argv[1] if len(sys.argv) > 1 else 'models/llama-2-7b-chat.Q4_K_M.gguf'
+n_ctx = 4096
+n_gpu_layers = -1
+max_tokens = 128
+requests_per_client = 4
+clients = [1, 4, 8]
+
+prompts = [
+    'a cinematic photo of a lighthouse in a storm, ',
+    'an oil painting of a fox in a snowy forest, ',
+    'a futuristic city at night, neon lights, ',
+    'portrait of an old sailor, dramatic lighting, ',
+    'a bowl of ramen, food photography, ',
+    'a castle on a floating island, fantasy art, ',
+    'a vintage car on a desert road, golden hour, ',
+    'macro photo of a dragonfly on a leaf, ',
+]
+
+
+def run_sequential(llm, n_requests):
+    generated = 0
+    start = time.perf_counter()
+    for i in range(n_requests):
+        response = llm.create_completion(prompts[i % len(prompts)], max_tokens=max_tokens, temperature=0)
+        generated += response['usage']['completion_tokens']
+    return generated, time.perf_counter() - start
+
+
+def run_batched(llm, n_clients):
+    scheduler = LlamaBatchScheduler(llm, n_slots=n_clients)
+
+    def client(index):
+        for i in range(requests_per_client):
+            scheduler.complete(prompts[(index + i) % len(prompts)], max_tokens=max_tokens, temperature=0)
+
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(n_clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    generated = scheduler.n_tokens_generated
+    steps = scheduler.n_steps
+    scheduler.close()
+    return generated, seconds, steps
+
+
+if __name__ == '__main__':
+    llm = Llama(model_path=model_path, n_ctx=n_ctx, n_gpu_layers=n_gpu_layers, verbose=False)
+
+    for n_clients in clients:
+        generated, seconds = run_sequential(llm, n_clients * requests_per_client)
+        print(f'{n_clients} clients, one after the other: {generated} tokens in {seconds:.1f}s, '
+              f'{generated / seconds:.1f} tokens/s')
+        llm.reset()
+
+        generated, seconds, steps = run_batched(llm, n_clients)
+        print(f'{n_clients} clients, continuous batching: {generated} tokens in {seconds:.1f}s, '
+              f'{generated / seconds:.1f} tokens/s, {steps} decode steps')
+        llm.reset()
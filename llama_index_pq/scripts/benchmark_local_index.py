@@ -0,0 +1,83 @@
+# Copyright 2023 osiworx
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# compares the local vector store against the Qdrant collection it was exported from,
+# the queries are stored prompts so both sides search the same corpus with the same vectors
+
+import os
+import sys
+import time
+
+import numpy as np
+import qdrant_client
+from qdrant_client.http import models
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pq'))
+from llm_fw.local_vector_store import local_qdrant_client
+
+
+qdrant_url = "http://localhost:6333"
+collection_name = "prompts_large_meta"
+local_index_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'local_index')
+
+queries = 500
+top_k = 10
+nprobes = [8, 16, 32, 64]
+
+
+def percentile_ms(times, p):
+    return np.percentile(np.array(times) * 1000, p)
+
+
+def timed_search(client, vectors):
+    times = []
+    results = []
+    for vector in vectors:
+        start = time.perf_counter()
+        points = client.search(collection_name=collection_name, query_vector=vector, limit=top_k, with_payload=True)
+        times.append(time.perf_counter() - start)
+        results.append({str(point.id) for point in points})
+    return times, results
+
+
+if __name__ == '__main__':
+    remote = qdrant_client.QdrantClient(url=qdrant_url)
+
+    # a deterministic sample of stored prompts, with a little noise so they are not their own exact match
+    points, _ = remote.scroll(collection_name=collection_name, limit=queries, with_vectors=True)
+    rng = np.random.default_rng(0)
+    vectors = [(np.array(point.vector) + rng.normal(scale=0.02, size=len(point.vector))).tolist() for point in points]
+
+    # exact search on the Qdrant side is the reference for recall
+    exact = []
+    for vector in vectors:
+        result = remote.search(collection_name=collection_name, query_vector=vector, limit=top_k,
+                               search_params=models.SearchParams(exact=True))
+        exact.append({str(point.id) for point in result})
+
+    qdrant_times, qdrant_results = timed_search(remote, vectors)
+    recall = np.mean([len(a & b) / top_k for a, b in zip(qdrant_results, exact)])
+    print(f'qdrant: recall@{top_k} {recall:.3f}, p50 {percentile_ms(qdrant_times, 50):.2f} ms, '
+          f'p99 {percentile_ms(qdrant_times, 99):.2f} ms')
+
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        local = local_qdrant_client(local_index_path, nprobe=nprobe)
+        local.get_collection(collection_name)
+        load = time.perf_counter() - start
+
+        local_times, local_results = timed_search(local, vectors)
+        recall = np.mean([len(a & b) / top_k for a, b in zip(local_results, exact)])
+        print(f'local nprobe {nprobe}: load {load:.2f}s, recall@{top_k} {recall:.3f}, '
+              f'p50 {percentile_ms(local_times, 50):.2f} ms, p99 {percentile_ms(local_times, 99):.2f} ms')
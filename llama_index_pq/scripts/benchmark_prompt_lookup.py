@@ -0,0 +1,80 @@
+# Copyright 2023 osiworx
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# time per draft call of the prompt lookup draft models in a generation loop, at 1k, 4k and 8k tokens
+# of context. the prompt is made of repeated phrases, like retrieved prompts that share their wording.
+# needs the llama_cpp folder of llama-cpp_windows in site-packages, see its Readme.md
+
+import time
+
+import numpy as np
+
+from llama_cpp.llama_speculative import LlamaPromptLookupDecoding, LlamaPromptLookupIndex
+
+
+contexts = [1000, 4000, 8000]
+generated_tokens = 256
+max_ngram_size = 3
+num_pred_tokens = 10
+phrase_tokens = 8
+phrases = 64
+n_vocab = 32000
+
+
+def sliding_window_draft(input_ids):
+    # the upstream draft model before it was vectorized, one window matrix per ngram size
+    input_length = input_ids.shape[0]
+    for ngram_size in range(min(max_ngram_size, input_length - 1), 0, -1):
+        windows = np.lib.stride_tricks.sliding_window_view(input_ids, (ngram_size,))
+        matches = np.all(windows == input_ids[-ngram_size:], axis=1)
+        for idx in np.nonzero(matches)[0]:
+            start_idx = idx + ngram_size
+            end_idx = min(start_idx + num_pred_tokens, input_length)
+            if start_idx < end_idx:
+                return input_ids[start_idx:end_idx]
+    return np.array([], dtype=np.intc)
+
+
+def generation_us(draft, prompt, continuation):
+    # every call sees the prompt plus the tokens generated so far, like the speculative loop of Llama.generate
+    input_ids = np.concatenate([prompt, continuation])
+    start = time.perf_counter()
+    for n in range(len(continuation)):
+        draft(input_ids[:len(prompt) + n + 1])
+    return (time.perf_counter() - start) / len(continuation) * 1e6
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    phrase_table = rng.integers(n_vocab, size=(phrases, phrase_tokens)).astype(np.intc)
+
+    for context in contexts:
+        tokens = phrase_table[rng.integers(phrases, size=context // phrase_tokens + 1)].reshape(-1)
+        prompt = tokens[:context]
+        continuation = phrase_table[rng.integers(phrases, size=generated_tokens // phrase_tokens + 1)].reshape(-1)
+        continuation = continuation[:generated_tokens]
+
+        sliding = generation_us(sliding_window_draft, prompt, continuation)
+        vectorized = generation_us(LlamaPromptLookupDecoding(max_ngram_size=max_ngram_size,
+                                                             num_pred_tokens=num_pred_tokens), prompt, continuation)
+
+        # the index is built on the first call of a new prompt, the generation loop then only extends it
+        index = LlamaPromptLookupIndex(max_ngram_size=max_ngram_size, num_pred_tokens=num_pred_tokens)
+        start = time.perf_counter()
+        index(prompt)
+        build = (time.perf_counter() - start) * 1000
+        indexed = generation_us(index, prompt, continuation)
+
+        print(f'{context} tokens: sliding window {sliding:.1f} us, vectorized {vectorized:.1f} us, '
+              f'n-gram index {indexed:.1f} us, index build {build:.1f} ms')
@@ -0,0 +1,72 @@
+# Copyright 2023 osiworx
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# longest prefix lookup of LlamaRAMCache through its token trie, against the scan over every key
+# it replaced. the states are empty, only the lookup is timed.
+# needs the llama_cpp folder of llama-cpp_windows in site-packages, see its Readme.md
+
+import time
+
+import numpy as np
+
+from llama_cpp import Llama, LlamaState
+from llama_cpp.llama_cache import LlamaRAMCache
+
+
+entries = [10, 100, 1000, 10000]
+header_tokens = 300
+key_tokens = 500
+query_tokens = 400
+n_vocab = 32000
+lookups = 20
+
+
+def linear_scan(keys, query):
+    # the lookup before the trie, every key is compared with the query
+    best_len = 0
+    best_key = None
+    for key in keys:
+        prefix_len = Llama.longest_token_prefix(key, query)
+        if prefix_len > best_len:
+            best_len = prefix_len
+            best_key = key
+    return best_key
+
+
+def per_lookup_us(function, query):
+    start = time.perf_counter()
+    for i in range(lookups):
+        function(query)
+    return (time.perf_counter() - start) / lookups * 1e6
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    # every key starts with the same template header, like the prompts of one model do
+    header = rng.integers(n_vocab, size=header_tokens).tolist()
+    state = LlamaState(input_ids=np.zeros(0, dtype=np.intc), scores=np.zeros((1, 1), dtype=np.single),
+                       n_tokens=0, llama_state=b'', llama_state_size=1)
+
+    for n_entries in entries:
+        cache = LlamaRAMCache(capacity_bytes=n_entries)
+        keys = [tuple(header + rng.integers(n_vocab, size=key_tokens - header_tokens).tolist())
+                for i in range(n_entries)]
+        for key in keys:
+            cache[key] = state
+        query = keys[n_entries // 2][:query_tokens]
+        assert cache._find_longest_prefix_key(query) == linear_scan(keys, query)
+
+        trie = per_lookup_us(cache._find_longest_prefix_key, query)
+        scan = per_lookup_us(lambda q: linear_scan(keys, q), query)
+        print(f'{n_entries} entries: trie lookup {trie:.1f} us, linear scan {scan:.1f} us')
@@ -0,0 +1,68 @@
+# Copyright 2023 osiworx
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# exports a Qdrant collection into the folder the local vector store reads,
+# set 'vector_store' to 'local' in the settings to use it
+
+import datetime
+import os
+import sys
+import time
+
+import qdrant_client
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pq'))
+from llm_fw.local_vector_store import local_index_writer
+
+
+qdrant_url = "http://localhost:6333"
+collection_name = "prompts_large_meta"
+
+# same default as 'local_index_path' in the settings, relative to the llama_index_pq folder
+local_index_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'local_index')
+
+page_size = 2048
+
+
+def log(text):
+    now = datetime.datetime.now()
+    print(f'{now.strftime("%H:%M:%S")} {text}')
+
+
+def export_collection(client, collection, path):
+    info = client.get_collection(collection_name=collection)
+    dim = info.config.params.vectors.size
+    log(f'exporting {info.points_count} points with {dim} dimensions from {collection}')
+
+    writer = local_index_writer(os.path.join(path, collection), dim)
+    start = time.time()
+    offset = None
+    while True:
+        points, offset = client.scroll(collection_name=collection, limit=page_size, offset=offset,
+                                       with_payload=True, with_vectors=True)
+        for point in points:
+            writer.add(point.id, point.vector, point.payload)
+        if writer.count % (page_size * 50) < page_size:
+            log(f'{writer.count} points, {writer.count / max(time.time() - start, 1e-6):.0f} points/sec')
+        if offset is None:
+            break
+
+    log(f'building the IVF index for {writer.count} points')
+    writer.finish()
+    log(f'done in {time.time() - start:.0f}s')
+
+
+if __name__ == '__main__':
+    client = qdrant_client.QdrantClient(url=qdrant_url)
+    export_collection(client, collection_name, local_index_path)
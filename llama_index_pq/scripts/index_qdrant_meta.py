@@ -14,40 +14,60 @@
 
 import datetime
 import os
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+import re
+import time
+import uuid
+import zlib
+import hashlib
+
+import numpy as np
 
 import qdrant_client
+from qdrant_client.http import models
+from sentence_transformers import SentenceTransformer
+
+from llama_index.core.schema import TextNode, MetadataMode
+from llama_index.core.vector_stores.utils import node_to_metadata_dict, metadata_dict_to_node
+
 
-from llama_index.core import (
-    VectorStoreIndex,
-    SimpleDirectoryReader,
-)
-from llama_index.core.storage.storage_context import StorageContext
-from llama_index.vector_stores.qdrant import QdrantVectorStore
-
-client = qdrant_client.QdrantClient(
-    # you can use :memory: mode for fast and light-weight experiments,
-    # it does not require to have Qdrant deployed anywhere
-    # but requires qdrant-client >= 1.1.1
-    #location=":memory:"
-    # otherwise set Qdrant instance address with:
-    url="http://192.168.0.127:6333"
-    # set API KEY for Qdrant Cloud
-    # api_key="<qdrant-api-key>",
-)
+qdrant_url = "http://192.168.0.127:6333"
+# set API KEY for Qdrant Cloud
+qdrant_api_key = None
 
 base_path = 'X:\\csv2'
+collection_name = "prompts_large_meta"
+embed_model_name = "sentence-transformers/all-MiniLM-L12-v2"
+
+# documents per embedding/upsert round, the embedding pool splits them over all cpu cores
+batch_size = 8192
+encode_batch_size = 256
+upsert_batch_size = 512
+
+# fixed namespace, the same prompt text always ends up with the same point id
+point_namespace = uuid.UUID('6f1b8a0e-4a52-4c8e-9d0e-5b7f2a1c3d44')
+
+meta_keys = ["file_path", "negative_prompt", "model_name"]
 
-sample_files_path = os.path.join(base_path)
+# quantized storage per collection: None, 'int8' (scalar) or 'pq' (product quantization),
+# the quantized vectors stay in RAM and the full vectors move to disk, search rescores with them
+collection_quantization = {
+    # "prompts_large_meta": 'int8',
+}
 
-embed_model = HuggingFaceEmbedding(model_name="sentence-transformers/all-MiniLM-L12-v2")
+# near duplicate detection with MinHash/LSH, prompts above the threshold get merged into the first one seen
+near_duplicates = False
+near_duplicate_threshold = 0.85
+# only the most recent prompts are compared, the signatures take near_duplicate_window * 512 bytes
+near_duplicate_window = 500000
 
-vector_store = QdrantVectorStore(client=client, collection_name="prompts_large_meta",)
-storage_context = StorageContext.from_defaults(vector_store=vector_store)
 
+def log(text):
+    now = datetime.datetime.now()
+    print(f'{now.strftime("%H:%M:%S")} {text}')
 
-def get_folder_file(path):
-    return path.replace(os.path.join(base_path,'prompt')+'\\','')
+
+def get_folder_file(base, path):
+    return os.path.relpath(path, base)
 
 
 def read_file(path):
@@ -60,42 +80,311 @@ def read_file(path):
         return ''
 
 
+def iter_files(path):
+    # walk lazily and in a stable order so a checkpoint always means the same thing
+    for subdir, dirs, files in os.walk(path):
+        dirs.sort()
+        for file in sorted(files):
+            yield os.path.join(subdir, file)
+
+
+def parse_record(text):
+    if '##superspacer##' in text:
+        meta_array = text.split('##superspacer##')
+        prompt = meta_array[1]
+        negative_prompt = meta_array[2] if len(meta_array) > 2 else ''
+        model_name = f'https://civitai.com/models/{meta_array[3]}' if len(meta_array) > 3 else ''
+    else:
+        prompt = text
+        negative_prompt = ''
+        model_name = ''
+    return prompt, negative_prompt, model_name
+
+
+def normalize_text(text):
+    return re.sub(r'\s+', ' ', text.lower()).strip(' ,')
+
+
+def text_hash(text):
+    return hashlib.sha1(normalize_text(text).encode('utf8')).hexdigest()
+
+
+def make_node(path, text):
+    prompt, negative_prompt, model_name = parse_record(text)
+    if prompt.strip() == '':
+        return None
+
+    # file_path and the meta data are not part of the embedding, same as the index built by llama_index
+    # negative_prompt and model_name are lists so duplicates can keep the meta data of every copy
+    return TextNode(id_=str(uuid.uuid5(point_namespace, text_hash(prompt))),
+                    text=prompt,
+                    metadata={'file_path': path,
+                              'negative_prompt': [negative_prompt] if negative_prompt != '' else [],
+                              'model_name': [model_name] if model_name != '' else []},
+                    excluded_embed_metadata_keys=list(meta_keys),
+                    excluded_llm_metadata_keys=list(meta_keys))
+
+
+def merge_metadata(node, other):
+    changed = False
+    for key in ['negative_prompt', 'model_name']:
+        values = node.metadata.get(key, [])
+        if isinstance(values, str):
+            values = [values] if values != '' else []
+        for value in other.metadata.get(key, []):
+            if value not in values:
+                values.append(value)
+                changed = True
+        node.metadata[key] = values
+    return changed
+
+
+class minhash_lsh:
+
+    def __init__(self, threshold=near_duplicate_threshold, num_perm=128, bands=16, shingle_size=5,
+                 window=near_duplicate_window):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(42)
+        # (a * x + b) mod p with x, a, b < p = 2^31 - 1 stays inside uint64
+        self.prime = np.uint64((1 << 31) - 1)
+        self.a = rng.randint(1, (1 << 31) - 1, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, (1 << 31) - 1, size=num_perm).astype(np.uint64)
+        # a ring of the last window signatures, the buckets hold their slots
+        self.window = window
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = np.zeros((window, num_perm), dtype=np.uint32)
+        self.keys = [None] * window
+        self.next = 0
+
+    def signature(self, text):
+        text = normalize_text(text)
+        n = self.shingle_size
+        shingles = {zlib.crc32(text[i:i + n].encode('utf8')) for i in range(max(1, len(text) - n + 1))}
+        x = np.fromiter(shingles, dtype=np.uint64, count=len(shingles)) % self.prime
+        # every hash is below 2^31, so the signature fits into uint32
+        return ((np.outer(x, self.a) + self.b) % self.prime).min(axis=0).astype(np.uint32)
+
+    def band_keys(self, sig):
+        return [sig[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def find_or_add(self, key, text):
+        # returns the key of an already seen near duplicate, or adds text under key and returns None
+        sig = self.signature(text)
+        band_keys = self.band_keys(sig)
+        candidates = []
+        for bucket, band_key in zip(self.buckets, band_keys):
+            candidates.extend(bucket.get(band_key, []))
+        if len(candidates) > 0:
+            candidates = list(dict.fromkeys(candidates))
+            similarity = (self.signatures[candidates] == sig).mean(axis=1)
+            best = int(np.argmax(similarity))
+            if similarity[best] >= self.threshold:
+                return self.keys[candidates[best]]
+        self.add(key, sig, band_keys)
+        return None
+
+    def add(self, key, sig, band_keys):
+        slot = self.next % self.window
+        if self.keys[slot] is not None:
+            # the oldest prompt leaves the window
+            for bucket, band_key in zip(self.buckets, self.band_keys(self.signatures[slot])):
+                slots = bucket[band_key]
+                slots.remove(slot)
+                if len(slots) == 0:
+                    del bucket[band_key]
+        self.signatures[slot] = sig
+        self.keys[slot] = key
+        self.next += 1
+        for bucket, band_key in zip(self.buckets, band_keys):
+            bucket.setdefault(band_key, []).append(slot)
+
+
+class prompt_dedup:
+
+    def __init__(self, near=near_duplicates):
+        self.lsh = minhash_lsh() if near else None
+        self.exact = 0
+        self.near = 0
+        self.existing = 0
+
+    def dedup(self, nodes):
+        unique = {}
+        for node in nodes:
+            if node.node_id in unique:
+                merge_metadata(unique[node.node_id], node)
+                self.exact += 1
+                continue
+            if self.lsh is not None:
+                match = self.lsh.find_or_add(node.node_id, node.text)
+                if match is not None:
+                    # near duplicates of earlier rounds are already stored, the merge happens there
+                    if match in unique:
+                        merge_metadata(unique[match], node)
+                        self.near += 1
+                    else:
+                        node.id_ = match
+                        unique[match] = node
+                    continue
+            unique[node.node_id] = node
+        return list(unique.values())
+
+    @property
+    def dropped(self):
+        return self.exact + self.near + self.existing
+
+
+def quantization_config(collection):
+    quantization = collection_quantization.get(collection)
+    if quantization == 'int8':
+        return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8,
+                                                                                quantile=0.99,
+                                                                                always_ram=True))
+    if quantization == 'pq':
+        return models.ProductQuantization(product=models.ProductQuantizationConfig(compression=models.CompressionRatio.X16,
+                                                                                   always_ram=True))
+    return None
+
+
+def load_checkpoint(checkpoint_file):
+    done = set()
+    if os.path.isfile(checkpoint_file):
+        f = open(checkpoint_file, 'r', encoding='utf8')
+        for line in f:
+            done.add(line.rstrip('\n'))
+        f.close()
+    return done
+
+
+class qdrant_indexer:
+
+    def __init__(self, collection=collection_name, url=qdrant_url, api_key=qdrant_api_key):
+        self.collection = collection
+        self.client = qdrant_client.QdrantClient(url=url, api_key=api_key)
+        self.model = SentenceTransformer(embed_model_name, device='cpu')
+        self.pool = None
+        self.dedup = prompt_dedup()
+        self.docs = 0
+        self.seconds = 0
+        self.embed_seconds = 0
+
+    def ensure_collection(self):
+        names = [c.name for c in self.client.get_collections().collections]
+        quantization = quantization_config(self.collection)
+        if self.collection not in names:
+            size = self.model.get_sentence_embedding_dimension()
+            self.client.create_collection(collection_name=self.collection,
+                                          vectors_config=models.VectorParams(size=size,
+                                                                             distance=models.Distance.COSINE,
+                                                                             on_disk=quantization is not None),
+                                          quantization_config=quantization)
+        elif quantization is not None:
+            self.client.update_collection(collection_name=self.collection,
+                                          vectors_config={'': models.VectorParamsDiff(on_disk=True)},
+                                          quantization_config=quantization)
+
+    def embed(self, texts):
+        return self.model.encode_multi_process(texts, self.pool, batch_size=encode_batch_size)
+
+    def upsert(self, nodes, vectors):
+        for start in range(0, len(nodes), upsert_batch_size):
+            points = [models.PointStruct(id=node.node_id,
+                                         vector=vector.tolist(),
+                                         payload=node_to_metadata_dict(node, remove_text=False, flat_metadata=False))
+                      for node, vector in zip(nodes[start:start + upsert_batch_size],
+                                              vectors[start:start + upsert_batch_size])]
+            self.client.upsert(collection_name=self.collection, points=points, wait=True)
+
+    def merge_existing(self, nodes):
+        # prompts already stored by an earlier round or run only get their meta data merged, no new embedding
+        existing = {}
+        for start in range(0, len(nodes), upsert_batch_size):
+            ids = [node.node_id for node in nodes[start:start + upsert_batch_size]]
+            for point in self.client.retrieve(collection_name=self.collection, ids=ids,
+                                              with_payload=True, with_vectors=False):
+                existing[str(point.id)] = point
 
-for subdir, dirs, files in os.walk(sample_files_path):
-    if len(files) > 0:
-        now = datetime.datetime.now()
-        print(f'{now.strftime("%H:%M:%S")} adding folder: {subdir}')
+        operations = []
+        new_nodes = []
+        for node in nodes:
+            point = existing.get(node.node_id)
+            if point is None:
+                new_nodes.append(node)
+                continue
+            self.dedup.existing += 1
+            stored = metadata_dict_to_node(point.payload)
+            if merge_metadata(stored, node):
+                operations.append(models.SetPayloadOperation(set_payload=models.SetPayload(
+                    payload=node_to_metadata_dict(stored, remove_text=False, flat_metadata=False),
+                    points=[point.id])))
 
-        documents = SimpleDirectoryReader(subdir).load_data()
+        for start in range(0, len(operations), upsert_batch_size):
+            self.client.batch_update_points(collection_name=self.collection,
+                                            update_operations=operations[start:start + upsert_batch_size])
+        return new_nodes
 
-        # here we set the file_path to become no part of the embedding, it's not for this use case
-        # also we check if a doc has zero content then we don't try to embedd it as it would result in an error
-        docs = []
-        for doc in documents:
+    def flush(self, nodes, files, checkpoint):
+        start = time.time()
+        read = len(nodes)
+        nodes = self.merge_existing(self.dedup.dedup(nodes))
+        if len(nodes) > 0:
+            embed_start = time.time()
+            vectors = self.embed([node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes])
+            self.embed_seconds += time.time() - embed_start
+            self.upsert(nodes, vectors)
 
-            if doc.text != '':
+        # only now the files are really in the index
+        checkpoint.write(''.join(f'{rel_path}\n' for rel_path in files))
+        checkpoint.flush()
 
-                doc.excluded_llm_metadata_keys.append("file_path")
-                doc.excluded_embed_metadata_keys.append("file_path")
-                doc.excluded_llm_metadata_keys.append("negative_prompt")
-                doc.excluded_embed_metadata_keys.append("negative_prompt")
-                doc.excluded_llm_metadata_keys.append("model_name")
-                doc.excluded_embed_metadata_keys.append("model_name")
+        self.docs += len(nodes)
+        self.seconds += time.time() - start
+        log(f'{self.docs} docs indexed, {read / max(time.time() - start, 1e-6):.1f} docs/sec, '
+            f'{self.docs / max(self.seconds, 1e-6):.1f} docs/sec overall')
+        self.log_dedup()
 
-                raw_text = doc.text
+    def log_dedup(self):
+        saved = self.dedup.dropped * self.embed_seconds / max(self.docs, 1)
+        log(f'duplicates dropped: {self.dedup.exact} exact, {self.dedup.near} near, '
+            f'{self.dedup.existing} already stored, ~{saved:.0f}s embedding time saved')
 
-                meta_array = doc.text.split('##superspacer##')
-                doc.text = meta_array[1]
+    def index_path(self, path, checkpoint_file):
+        self.ensure_collection()
+        done = load_checkpoint(checkpoint_file)
+        if len(done) > 0:
+            log(f'resuming, {len(done)} files already indexed')
 
-                doc.metadata['negative_prompt'] = meta_array[2]
-                doc.metadata['model_name'] = f'https://civitai.com/models/{meta_array[3]}'
-                docs = docs + [doc]
+        self.pool = self.model.start_multi_process_pool(['cpu'] * os.cpu_count())
+        checkpoint = open(checkpoint_file, 'a', encoding='utf8')
+        try:
+            nodes = []
+            files = []
+            for file in iter_files(path):
+                rel_path = get_folder_file(path, file)
+                if rel_path in done:
+                    continue
 
+                node = make_node(file, read_file(file))
+                if node is not None:
+                    nodes.append(node)
+                files.append(rel_path)
 
-        del documents
+                if len(nodes) >= batch_size:
+                    self.flush(nodes, files, checkpoint)
+                    nodes = []
+                    files = []
 
-        index = VectorStoreIndex.from_documents(
-            docs, storage_context=storage_context, embed_model=embed_model, show_progress=True
-        )
+            if len(files) > 0:
+                self.flush(nodes, files, checkpoint)
+        finally:
+            checkpoint.close()
+            self.model.stop_multi_process_pool(self.pool)
+            self.pool = None
 
 
+if __name__ == '__main__':
+    log(f'indexing {base_path} into {collection_name}')
+    indexer = qdrant_indexer()
+    indexer.index_path(base_path, 'index_qdrant_meta.ckpt')
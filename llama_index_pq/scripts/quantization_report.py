@@ -0,0 +1,96 @@
+# Copyright 2023 osiworx
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# recall@k and memory of a quantized collection compared to its full float32 vectors,
+# set apply_quantization to quantize the collection first (see collection_quantization in index_qdrant_meta.py)
+
+import time
+
+import numpy as np
+import qdrant_client
+from qdrant_client.http import models
+
+from index_qdrant_meta import quantization_config, collection_quantization, log
+
+
+qdrant_url = "http://localhost:6333"
+collection_name = "prompts_large_meta"
+
+# None keeps the collection as it is, 'int8' or 'pq' quantizes it before the report
+apply_quantization = None
+
+queries = 200
+top_k = 10
+
+
+def wait_for_green(client):
+    while client.get_collection(collection_name=collection_name).status != models.CollectionStatus.GREEN:
+        time.sleep(5)
+
+
+def run_queries(client, vectors, params):
+    results = []
+    start = time.perf_counter()
+    for vector in vectors:
+        points = client.search(collection_name=collection_name, query_vector=vector, limit=top_k, search_params=params)
+        results.append({str(point.id) for point in points})
+    return results, (time.perf_counter() - start) / len(vectors) * 1000
+
+
+def memory_report(count, dim, quantization):
+    full = count * dim * 4
+    log(f'float32 vectors: {full / (1 << 30):.2f} GB in RAM')
+    if quantization is None:
+        return
+    if isinstance(quantization, models.ScalarQuantization):
+        quantized = count * dim
+    else:
+        quantized = count * dim * 4 // 16
+    log(f'quantized vectors: {quantized / (1 << 30):.2f} GB in RAM, full vectors on disk, '
+        f'{full / quantized:.0f}x less vector RAM')
+
+
+if __name__ == '__main__':
+    client = qdrant_client.QdrantClient(url=qdrant_url)
+
+    if apply_quantization is not None:
+        collection_quantization[collection_name] = apply_quantization
+        log(f'quantizing {collection_name} as {apply_quantization}')
+        client.update_collection(collection_name=collection_name,
+                                 vectors_config={'': models.VectorParamsDiff(on_disk=True)},
+                                 quantization_config=quantization_config(collection_name))
+        wait_for_green(client)
+
+    info = client.get_collection(collection_name=collection_name)
+    dim = info.config.params.vectors.size
+    quantization = info.config.quantization_config
+    log(f'{collection_name}: {info.points_count} points, quantization: {quantization}')
+    memory_report(info.points_count, dim, quantization)
+
+    points, _ = client.scroll(collection_name=collection_name, limit=queries, with_vectors=True)
+    rng = np.random.default_rng(0)
+    vectors = [(np.array(point.vector) + rng.normal(scale=0.02, size=dim)).tolist() for point in points]
+
+    exact, _ = run_queries(client, vectors, models.SearchParams(exact=True))
+    modes = {
+        'float32 hnsw': models.SearchParams(quantization=models.QuantizationSearchParams(ignore=True)),
+        'quantized': models.SearchParams(quantization=models.QuantizationSearchParams(rescore=False)),
+        'quantized + rescore': models.SearchParams(quantization=models.QuantizationSearchParams(rescore=True)),
+        'quantized + rescore, 2x oversampling': models.SearchParams(
+            quantization=models.QuantizationSearchParams(rescore=True, oversampling=2.0)),
+    }
+    for name, params in modes.items():
+        results, ms = run_queries(client, vectors, params)
+        recall = np.mean([len(a & b) / top_k for a, b in zip(results, exact)])
+        log(f'{name}: recall@{top_k} {recall:.3f}, {ms:.2f} ms/query')